@@ -6,15 +6,22 @@ Tomato.tests
 import unittest
 import msgpack
 import time
+import zlib
+from cStringIO import StringIO
 
 try:
     from PIL import Image
 except ImportError:
     import Image
 
-from tomato.swf_processor import Swf
-from tomato.exceptions_tomato import MovieClipDoesNotExist
-from tomato.utils import bits_list2string, Bits, SignedBits as SB, FixedPointBits as FB, MATRIX
+from tomato.swf_processor import Swf, CharacterIdAllocator
+from tomato.exceptions_tomato import MovieClipDoesNotExist, CharacterIdExhausted, \
+     CircularReference, InvalidSWF
+from tomato.parser import rewrite_tags, iter_tags, read_swf_head
+from tomato.swf_injector import create_swf, decompress, PrecompressedSwf
+from tomato import structure
+from tomato.utils import _h16, le2byte, bits_list2string, Bits, SignedBits as SB, FixedPointBits as FB, MATRIX, \
+     FieldsIO, BitReader, BitWriter, RECT
 
 
 def test_matrix(scale=None, rotate=None, translate=(0,0)):
@@ -37,10 +44,23 @@ def test_matrix(scale=None, rotate=None, translate=(0,0)):
     return m1.value == m2.value
 
 
+def make_button_swf(value, ch_ids):
+    "DefineSprite 2 を、ch_ids のキャラクターを並べた DefineButton2 に置き換える"
+    matrix = MATRIX().generate(translate=(100, 200)).value
+    body = _h16(2) + '\x00' + _h16(0)
+    for depth, ch_id in enumerate(ch_ids, 1):
+        body += '\x0f' + _h16(ch_id) + _h16(depth) + matrix + '\x00'
+    body += '\x00'
+    out = StringIO()
+    rewrite_tags(StringIO(value), out, lambda tag, header, b:
+                 (34, body) if tag == 39 and le2byte(b[:2]) == 2 else (tag, b))
+    return out.getvalue()
+
+
 class TestSwfProcessor(unittest.TestCase):
     def setUp(self):
         self.swf_bitmap = Swf(open('sample/bitmap/bitmap.swf').read())
-        self.swf_tank = Swf(open('sample/mc/tank.swf').read())
+        self.swf_tank = Swf.open('sample/mc/tank.swf')
 
     def test_bits(self):
         int_num = 31415
@@ -72,15 +92,610 @@ class TestSwfProcessor(unittest.TestCase):
         m2 = MATRIX().deserialize(tpl)
         self.assertEqual(m1.value, m2.value)
 
+    def test_compiled_fields_io(self):
+        m1 = MATRIX().generate(
+            scale=(2.4, 3.7),
+            rotate=(-1, 5),
+            translate=(1500, -1500))
+        m2 = MATRIX()
+        m2.parse(structure.StreamIO(m1.value))
+        m3 = MATRIX()
+        FieldsIO.parse(m3, structure.StreamIO(m1.value))   # 汎用のパース
+        self.assertEqual(m1.serialize(), m2.serialize())
+        self.assertEqual(FieldsIO.serialize(m3), m2.serialize())
+        self.assertEqual(FieldsIO.value.fget(m3), m2.value)
+
+    def test_bit_reader_and_writer(self):
+        w = BitWriter()
+        w.write_bits(5, 3)
+        w.write_bits(-3, 7)
+        w.write_bits(0x1234, 16)
+        self.assertEqual(26, len(w))
+        self.assertEqual('\xbf\x44\x8d\x00', w.tostring())
+        r = BitReader(w.tostring())
+        self.assertEqual(5, r.get_bits(3))
+        self.assertEqual(5, r.read_bits(3))
+        self.assertEqual(-3, r.read_sbits(7))
+        self.assertEqual(0x1234, r.read_bits(16))
+        r.align_byte()
+        self.assertEqual(32, r.bpos)
+
+    def test_shape_records(self):
+        bitmap = Swf(open('sample/bitmap/bitmap.swf').read(), PARSE_SHAPE=True)
+        shape = bitmap.character_dict[9]
+        self.assertEqual('DefineShape2', shape.tag_name)
+        records = shape.Shapes.ShapeRecords
+        self.assertEqual(12, len(records))
+        self.assertEqual(structure.STYLE_CHANGE_RECORD, records.kinds[0])
+        self.assertEqual(structure.END_SHAPE_RECORD, records.kinds[-1])
+        self.assertEqual([5], records.new_styles.keys())
+        self.assertEqual(len(shape.buf), shape.pos)
+
+    def test_recompute_bounds(self):
+        tank = open('sample/mc/tank.swf').read()
+        swf = Swf(tank, PARSE_SHAPE=True)
+        shape = swf.character_dict[1]
+        self.assertEqual((-3148, -216, -4064, 4599), shape.get_bounds())
+        shape.recompute_bounds()
+        self.assertEqual(tank, swf.write())
+
+        rect = RECT()
+        for attr in ('x_min', 'x_max', 'y_min', 'y_max'):
+            rect.setattr_value(attr, 0)
+        rect.generate_bits()
+        shape.replace_rect(rect)
+        self.assertNotEqual(tank, swf.write())
+        shape.recompute_bounds()
+        self.assertEqual(tank, swf.write())
+
+        # RECT の長さが変わっても FILLSTYLE の BitmapId の位置はずれない
+        swf = Swf(open('sample/bitmap/bitmap.swf').read(), PARSE_SHAPE=True)
+        shape = swf.character_dict[5]
+        shape.replace_rect(rect)
+        for offset, bitmap_id in shape.reference_offsets():
+            self.assertEqual(4, bitmap_id)
+            self.assertEqual(4, le2byte(shape.buf[offset:(offset + 2)]))
+
     def test_getting_movie_clip(self):
         self.assertNotEqual(None, self.swf_tank.get_movie_clip('kombu'))
         self.assertRaises(MovieClipDoesNotExist, 
             self.swf_bitmap.get_movie_clip, 'this_is_not_spam')
 
+    def test_name_index(self):
+        tank = self.swf_tank
+        self.assertEqual(['kombu', 'fish1', 'fish2'], tank.get_movie_clip_name())
+        fish_red = Swf.open('sample/mc/fish_red_fin.swf')
+        self.assertEqual('fin', fish_red.get_movie_clip_from_parent('red', 'fin').place_object2.name)
+
+        mc = tank.replace_movie_clip('fish1', fish_red.get_movie_clip('red'))
+        self.assertEqual(mc.place_object2, tank.get_movie_clip('fish1').place_object2)
+        self.assertTrue('fin' in tank.get_movie_clip_name())
+        mc.set_name('fish3')
+        self.assertEqual(mc.place_object2, tank.get_movie_clip('fish3').place_object2)
+        self.assertRaises(MovieClipDoesNotExist, tank.get_movie_clip, 'fish1')
+        tank.delete_movie_clip('kombu')
+        self.assertRaises(MovieClipDoesNotExist, tank.get_movie_clip, 'kombu')
+        self.assertEqual(Swf(tank.write()).get_movie_clip_name(), tank.get_movie_clip_name())
+
+        # DefineSprite 内の名前を変えた場合は DefineSprite も更新する
+        fish_red.get_movie_clip_from_parent('red', 'fin').set_name('tail')
+        self.assertEqual(
+            'tail', Swf(fish_red.write()).get_movie_clip_from_parent('red', 'tail').place_object2.name)
+
+        # 同じ名前が複数ある場合は、置き換えた後も最初のものを返す
+        tank = Swf.open('sample/mc/tank.swf')
+        tank.get_movie_clip('fish2').set_name('fish1')
+        first = tank.get_movie_clip('fish1').place_object2
+        tank.replace_movie_clip('fish1', fish_red.get_movie_clip('red'))
+        self.assertEqual(first, tank.get_movie_clip('fish1').place_object2)
+        self.assertEqual(Swf(tank.write()).get_movie_clip_name(), tank.get_movie_clip_name())
+
+    def test_reference_index(self):
+        tank = self.swf_tank
+        red = Swf.open('sample/mc/fish_red.swf').get_movie_clip('red')
+        mc1 = tank.replace_movie_clip('fish1', red)
+        mc2 = tank.replace_movie_clip('fish2', red)
+        ds_id = mc1.define_sprite.character_id
+        self.assertEqual([(mc1.place_object2, None)], tank.reference_index.get(ds_id))
+        mc = structure.MovieClip(tank, mc2.define_sprite, None)
+        mc.get_place_object2()
+        self.assertEqual(mc2.place_object2, mc.place_object2)
+
+        # fish1 の DefineSprite を消しても fish2 と共有している DefinitionTag は残す
+        mc1.place_object2.set_target_character_id(mc2.define_sprite.character_id)
+        self.assertFalse(tank.is_referenced(ds_id))
+        tank.vanish_movie_clip(mc1)
+        swf = Swf(tank.write())
+        for p in swf.search_tags('PlaceObject2'):
+            if p.target_character_id:
+                self.assertTrue(p.target_character_id in swf.character_dict)
+
+    def test_tag_index(self):
+        tank = self.swf_tank
+        po2s = tank.search_tags('PlaceObject2')
+        self.assertEqual(po2s, list(tank.iter_search_tags('PlaceObject2')))
+        self.assertEqual(
+            [b for b in tank.blocks if isinstance(b, structure.PlaceObject2)],
+            tank.search_root('PlaceObject2'))
+        self.assertTrue((26, 'PlaceObject2') in tank.print_used_tags())
+
+        kombu = tank.get_movie_clip('kombu').place_object2
+        tank.delete_movie_clip('kombu')
+        self.assertEqual(len(po2s) - 1, len(tank.search_tags('PlaceObject2')))
+        self.assertFalse(kombu in tank.search_tags('PlaceObject2'))
+        red = Swf.open('sample/mc/fish_red.swf').get_movie_clip('red')
+        mc = tank.replace_movie_clip('fish1', red)
+        self.assertTrue(mc.define_sprite in tank.search_root('DefineSprite'))
+        # 書き換えた, 加えたブロックも Swf 内の順番に並ぶ
+        for name in ('PlaceObject2', 'DefineSprite'):
+            self.assertEqual(tank.search_tags(name, tank.blocks), tank.search_tags(name))
+
+    def test_hash_index(self):
+        tank = Swf.open('sample/mc/tank.swf', PARSE_SHAPE=True)
+        shape = tank.search_root('DefineShape')[0]
+        old = shape.copy()
+        self.assertEqual(shape.character_id, tank.get_same_definition_tag(old))
+        # 内容を変えると索引も更新される
+        rect = RECT()
+        for attr in ('x_min', 'x_max', 'y_min', 'y_max'):
+            rect.setattr_value(attr, 0)
+        rect.generate_bits()
+        shape.replace_rect(rect)
+        self.assertEqual(None, tank.get_same_definition_tag(old))
+        self.assertEqual(shape.character_id,
+                         tank.get_same_definition_tag(shape.copy()))
+
+        red = Swf.open('sample/mc/fish_red.swf').get_movie_clip('red')
+        tank.replace_movie_clip('fish1', red)
+        ids = set(tank.character_dict)
+        # 2回目は DefineSprite 以外の DefinitionTag を共有する
+        tank.replace_movie_clip('fish2', red)
+        for ch_id in set(tank.character_dict) - ids:
+            self.assertTrue(
+                isinstance(tank.character_dict[ch_id], structure.DefineSprite))
+
+    def test_character_id_allocator(self):
+        tank = Swf.open('sample/mc/tank.swf')
+        red = Swf.open('sample/mc/fish_red.swf').get_movie_clip('red')
+        white = Swf.open('sample/mc/fish_white.swf').get_movie_clip('white')
+        tank.replace_movie_clip_with_vanishing('fish1', red)
+        tank.replace_movie_clip_with_vanishing('fish1', white)
+        high = max(tank.character_dict)
+        # 消した MovieClip の character_id を再利用するので増え続けない
+        for i in range(3):
+            tank.replace_movie_clip_with_vanishing('fish1', red)
+            tank.replace_movie_clip_with_vanishing('fish1', white)
+        self.assertEqual(high, max(tank.character_dict))
+        self.assertEqual(sorted(tank.character_dict),
+                         sorted(Swf(tank.write()).character_dict))
+
+        # まだ ID を振っていない Swf で解放した ID も再利用する
+        tank = Swf.open('sample/mc/tank.swf')
+        tank.delete_movie_clip('kombu')
+        self.assertEqual([1, 2], tank.collect_garbage())
+        self.assertEqual([1, 2], sorted([tank.get_new_character_id(), tank.get_new_character_id()]))
+        self.assertEqual(7, tank.get_new_character_id())
+
+        allocator = CharacterIdAllocator([0xfffe])
+        self.assertEqual(0xffff, allocator.allocate())
+        self.assertRaises(CharacterIdExhausted, allocator.allocate)
+        allocator.release(3)
+        self.assertEqual(3, allocator.allocate())
+
+    def test_dependency_graph(self):
+        swf = Swf.open('sample/mc/fish_red_fin.swf')
+        graph = swf.dependency_graph
+        red = swf.get_movie_clip('red').define_sprite
+        fin = swf.get_movie_clip('fin').define_sprite
+        self.assertEqual({1: [1, 3], 2: [2]}, graph.layers(red.character_id))
+        self.assertEqual(set([1, 2, 3]), graph.closure(red.character_id))
+        self.assertEqual(2, graph.height(red.character_id))
+        # 呼び出し毎に結果が混ざらない
+        self.assertEqual({1: set([2])}, dict(swf.get_all_definition_tags(fin)))
+        self.assertEqual({1: set([2])}, dict(swf.get_all_definition_tags(fin)))
+
+        # fin が red を配置すると循環する
+        po2 = [b for b in fin.blocks if isinstance(b, structure.PlaceObject2)][0]
+        po2.set_target_character_id(red.character_id)
+        self.assertEqual(set([1, 3, 4]), graph.closure(red.character_id))
+        self.assertRaises(CircularReference, graph.height, red.character_id)
+
+    def test_find_movie_clip(self):
+        red = Swf.open('sample/mc/fish_red_fin.swf')
+        fin = red.find('red/fin')
+        self.assertEqual(red.get_movie_clip('fin').place_object2, fin.place_object2)
+        self.assertRaises(MovieClipDoesNotExist, red.find, 'fin')
+        self.assertRaises(MovieClipDoesNotExist, red.find, 'red/fin/spam')
+
+        tank = self.swf_tank
+        tank.replace_movie_clip('fish1', red.find('red'))
+        self.assertEqual(['fin'],
+                         [mc.place_object2.name for mc in tank.find_all('*/f?n')])
+        self.assertEqual(set(['fish1', 'fish2']),
+                         set(mc.place_object2.name for mc in tank.find_all('fish*')))
+        self.assertEqual([], tank.find_all('kombu/*'))
+
+    def test_sprite_hash_index(self):
+        tank = self.swf_tank
+        red = Swf.open('sample/mc/fish_red_fin.swf')
+        tank.replace_movie_clip('fish1', red.find('red'))
+        ids = set(tank.character_dict)
+        # 2回目は内部の DefineSprite も共有し、置き換えた DefineSprite だけが増える
+        mc = tank.replace_movie_clip('fish2', red.find('red'))
+        self.assertEqual(set([mc.define_sprite.character_id]),
+                         set(tank.character_dict) - ids)
+        self.assertEqual(tank.find('fish1/fin').define_sprite,
+                         tank.find('fish2/fin').define_sprite)
+
+        # 内部の配置先が変わると構造的なハッシュも変わる
+        index = tank.sprite_hash_index
+        fin = tank.find('fish1/fin').define_sprite
+        digest = index.structural_hash(fin)
+        self.assertEqual([fin], index.get(digest))
+        po2 = [b for b in fin.blocks if isinstance(b, structure.PlaceObject2)][0]
+        po2.set_target_character_id(1)
+        self.assertEqual([], index.get(digest))
+        self.assertNotEqual(digest, index.structural_hash(fin))
+
+    def test_collect_garbage(self):
+        red = Swf.open('sample/mc/fish_red_fin.swf').get_movie_clip('red')
+        vanished = Swf.open('sample/mc/tank.swf')
+        vanished.replace_movie_clip_with_vanishing('kombu', red)
+        tank = Swf.open('sample/mc/tank.swf', LAZY=True)
+        tank.replace_movie_clip('kombu', red)
+        self.assertEqual(vanished.write(), tank.write(gc=True))
+        self.assertEqual([], tank.collect_garbage())
+
+        tank = self.swf_tank
+        tank.delete_movie_clip('kombu')
+        without_kombu = tank.write()
+        self.assertEqual([1, 2], tank.collect_garbage())
+        self.assertEqual([3, 4, 5, 6], sorted(Swf(tank.write()).character_dict))
+
+        # PlaceObject2 をパースしていなくても buf から参照先を読む
+        for parse in ((), ('DefineSprite',)):
+            swf = Swf(without_kombu, parse=parse)
+            self.assertEqual([1, 2], swf.collect_garbage())
+            self.assertEqual(tank.write(), swf.write())
+
+        # ビットマップ, フォントも辿る
+        bitmap = open('sample/bitmap/bitmap.swf').read()
+        swf = Swf(bitmap)
+        self.assertEqual([], swf.collect_garbage())
+        self.assertEqual(bitmap, swf.write())
+
+    def test_dedupe_definitions(self):
+        tank = open('sample/mc/tank.swf').read()
+        swf = Swf(tank)
+        ds = swf.character_dict[2]
+        new_id = swf.insert_definition_tag(swf.character_dict[1], ds)
+        ds.blocks[0].set_target_character_id(new_id)
+        ds.update_value()
+        duplicated = swf.write()
+        self.assertNotEqual(tank, duplicated)
+        self.assertEqual({new_id: 1}, swf.dedupe_definitions())
+        self.assertEqual(tank, swf.write())
+        self.assertEqual({}, swf.dedupe_definitions())
+
+        # パースしていない DefineSprite 内の PlaceObject2 も書き換える
+        for kwargs in ({'parse': ()}, {'parse': ('DefineSprite',)}, {'LAZY': True}):
+            swf = Swf(duplicated, **kwargs)
+            self.assertEqual({new_id: 1}, swf.dedupe_definitions())
+            self.assertEqual(tank, swf.write())
+
+        # DefineButton2 の参照先も書き換える
+        swf = Swf(make_button_swf(duplicated, (3, new_id)))
+        self.assertEqual({new_id: 1}, swf.dedupe_definitions())
+        self.assertEqual(make_button_swf(tank, (3, 1)), swf.write())
+
+        # 同じ内容の DefineSprite もまとめる
+        swf = Swf(tank)
+        fish2 = swf.get_movie_clip('fish2')
+        after = swf.blocks[swf.blocks.index(fish2.define_sprite) + 1]
+        sprite_id = swf.insert_definition_tag(fish2.define_sprite, after)
+        fish2.place_object2.set_target_character_id(sprite_id)
+        self.assertNotEqual(tank, swf.write())
+        self.assertEqual({sprite_id: 6}, swf.dedupe_definitions())
+        self.assertEqual(tank, swf.write())
+
+        # ハッシュが衝突しても内容が違えばまとめない
+        structure.set_hash_function(lambda value: 'collision')
+        try:
+            swf = Swf(tank)
+            self.assertEqual({}, swf.dedupe_definitions())
+            self.assertEqual(tank, swf.write())
+            shape = Swf(tank).character_dict[3]
+            self.assertEqual(3, swf.get_same_definition_tag(shape))
+        finally:
+            structure.set_hash_function(structure.md5_digest)
+
+        # RECT を書き換えて位置のずれたシェイプのビットマップの参照先も書き換える
+        swf = Swf(open('sample/bitmap/bitmap.swf').read(), PARSE_SHAPE=True)
+        shape = swf.character_dict[5]
+        rect = RECT()
+        for attr, v in zip(('x_min', 'x_max', 'y_min', 'y_max'), (-20000, 20000, -20000, 20000)):
+            rect.setattr_value(attr, v)
+        rect.generate_bits()
+        shape.replace_rect(rect)
+        bitmap_id = swf.insert_definition_tag(swf.character_dict[4], shape)
+        self.assertTrue(shape.replace_references({4: bitmap_id}))
+        self.assertEqual([bitmap_id], shape.references())
+        self.assertEqual({bitmap_id: 4}, swf.dedupe_definitions())
+        self.assertEqual([4], Swf(swf.write()).character_dict[5].references())
+
+        # value を直接書き換えた場合も今の buf から位置を求める
+        wide = shape.value
+        shape = Swf(open('sample/bitmap/bitmap.swf').read(), PARSE_SHAPE=True).character_dict[5]
+        self.assertEqual([4], shape.references())
+        shape.value = wide
+        self.assertEqual([(offset, 4) for offset, ch_id in shape.reference_offsets()],
+                         [(offset, le2byte(wide[offset:(offset + 2)]))
+                          for offset, ch_id in shape.reference_offsets()])
+        self.assertEqual(wide, Swf(swf.write()).character_dict[5].value)
+
+        bitmap = open('sample/bitmap/bitmap.swf').read()
+        swf = Swf(bitmap)
+        self.assertEqual({}, swf.dedupe_definitions())
+        self.assertEqual(bitmap, swf.write())
+
+    def test_batch(self):
+        matrix = MATRIX().generate(scale=(1.5, 2.0), translate=(300, 400))
+        def move(swf):
+            for ds in [swf.character_dict[i] for i in (2, 4, 6)]:
+                for block in ds.blocks:
+                    if isinstance(block, structure.PlaceObject2) and block.f_place_has_matrix:
+                        block.replace_matrix(matrix)
+                        block.replace_matrix(matrix)
+        swf = Swf.open('sample/mc/tank.swf')
+        move(swf)
+        expected = swf.write()
+
+        swf = Swf.open('sample/mc/tank.swf')
+        values = [swf.character_dict[i].value for i in (2, 4, 6)]
+        with swf.batch():
+            with swf.batch():
+                move(swf)
+            # 抜けるまでは DefineSprite を更新しない
+            self.assertEqual(3, len(swf.dirty))
+            self.assertEqual(values, [swf.character_dict[i].value for i in (2, 4, 6)])
+        self.assertEqual(None, swf.dirty)
+        self.assertNotEqual(values, [swf.character_dict[i].value for i in (2, 4, 6)])
+        self.assertEqual(expected, swf.write())
+
+        # batch の中で書き出す場合も更新してから出力する
+        swf = Swf.open('sample/mc/tank.swf')
+        with swf.batch():
+            move(swf)
+            self.assertEqual(expected, ''.join(map(str, swf.iter_chunks())))
+            move(swf)
+            self.assertEqual(expected, swf.write())
+
+        # batch の中でコピー, シリアライズする場合も更新してから行う
+        swf = Swf.open('sample/mc/tank.swf')
+        with swf.batch():
+            move(swf)
+            self.assertEqual(expected, swf.copy().write())
+        swf = Swf.open('sample/mc/tank.swf')
+        with swf.batch():
+            move(swf)
+            copied = swf.character_dict[4].copy()
+            data = swf.serialize()
+        loaded = Swf()
+        loaded.deserialize(data)
+        self.assertEqual(expected, loaded.write())
+        self.assertEqual(swf.character_dict[4].value, copied.value)
+
+    def test_collect_garbage_button(self):
+        # kombu の DefineSprite を、シェイプ 3, 1 を使う DefineButton2 に置き換える
+        button = make_button_swf(open('sample/mc/tank.swf').read(), (3, 1))
+        swf = Swf(button)
+        self.assertEqual([3, 1], swf.character_dict[2].references())
+        self.assertEqual([], swf.collect_garbage())
+        self.assertEqual(button, swf.write())
+
+    def test_collect_garbage_gradient(self):
+        # グラデーションの後にビットマップを参照する FILLSTYLE を持つシェイプ
+        matrix = MATRIX().generate(scale=(1.5, 2.0), translate=(300, 400)).value
+        rect = RECT()
+        for attr in ('x_min', 'x_max', 'y_min', 'y_max'):
+            rect.setattr_value(attr, 0)
+        rect.generate_bits()
+        records = '\x00\xff\x00\x00' + '\xff\x00\xff\x00'   # GRADRECORD (Ratio, RGB)
+        fill_styles = '\x03' + \
+            '\x10' + matrix + '\x02' + records + \
+            '\x13' + matrix + '\x02' + records + '\x00\x01' + \
+            '\x41' + _h16(4) + matrix
+        body = _h16(5) + rect.value + fill_styles + '\x00' + '\x20' + '\x00'
+        out = StringIO()
+        rewrite_tags(open('sample/bitmap/bitmap.swf'), out, lambda tag, header, b:
+                     (2, body) if tag == 2 else (tag, b))
+        swf = Swf(out.getvalue())
+        self.assertEqual([4], swf.character_dict[5].references())
+        self.assertEqual([], swf.collect_garbage())
+        self.assertEqual(out.getvalue(), swf.write())
+
+        # 最後まで読めないシェイプの参照先は分からないので何も取り除かない
+        out = StringIO()
+        rewrite_tags(open('sample/bitmap/bitmap.swf'), out, lambda tag, header, b:
+                     (2, body.replace('\x13', '\x14')) if tag == 2 else (tag, b))
+        swf = Swf(out.getvalue())
+        self.assertEqual(None, swf.character_dict[5].references())
+        self.assertEqual([], swf.collect_garbage())
+
     def test_delete_movie_clip(self):
         self.swf_tank.delete_movie_clip('kombu')
         self.swf_tank.write(open('sample/mc/tank_without_kombu.swf', 'w'))
 
+    def test_blocks_share_swf_buffer(self):
+        tank = open('sample/mc/tank.swf').read()
+        swf = Swf(tank)
+        for block in swf.blocks:
+            self.assertEqual(buffer, type(block.buf))
+            for child in getattr(block, 'blocks', []):
+                self.assertEqual(buffer, type(child.buf))
+        self.assertEqual(tank, swf.write())
+
+    def test_lazy_swf(self):
+        tank = open('sample/mc/tank.swf').read()
+        lazy_tank = Swf(tank, LAZY=True)
+        self.assertEqual({}, lazy_tank.blocks.built)
+        self.assertEqual(tank, lazy_tank.write())
+        self.assertNotEqual(None, lazy_tank.get_movie_clip('kombu'))
+        self.assertEqual(
+            sorted(self.swf_tank.character_dict),
+            sorted(lazy_tank.character_dict))
+        self.assertEqual(self.swf_tank.copy().write(), lazy_tank.copy().write())
+
+    def test_lazy_swf_write_after_edit(self):
+        # character_dict から取り出して変更したタグも書き出す
+        def edit(swf):
+            swf.character_dict[1].set_character_id(77)
+            ds = swf.character_dict[2]
+            ds.blocks[0].set_depth(5)
+            ds.update_value()
+            return swf
+        tank = open('sample/mc/tank.swf').read()
+        expected = edit(Swf(tank)).write()
+        self.assertNotEqual(tank, expected)
+        lazy_tank = edit(Swf(tank, LAZY=True))
+        self.assertEqual(expected, lazy_tank.write())
+        self.assertEqual(expected, lazy_tank.copy().write())
+        self.assertEqual(
+            sorted(Swf(expected).character_dict), sorted(lazy_tank.get_character_dict()))
+
+    def test_open_swf(self):
+        tank = open('sample/mc/tank.swf').read()
+        swf = Swf.open('sample/mc/tank.swf')
+        self.assertEqual(tank, swf.write())
+        swf.get_movie_clip('kombu').set_translate(10, 20)
+        self.assertEqual(
+            Swf(swf.write()).get_movie_clip('kombu').translate, (10, 20))
+        swf.close()
+        self.assertEqual(None, swf.mmap)
+
+        with Swf.open('sample/mc/tank.swf') as swf:
+            mapped = swf.mmap
+            self.assertEqual(tank, swf.write())
+        self.assertEqual(None, swf.mmap)
+        self.assertRaises(ValueError, mapped.read, 1)
+
+    def test_rewrite_tags(self):
+        params = open('sample/params/params.swf').read()
+        out = StringIO()
+        rewrite_tags(StringIO(params), out, lambda tag, header, body: (tag, body))
+        self.assertEqual(params, out.getvalue())
+
+        out = StringIO()
+        rewrite_tags(StringIO(params), out,
+                     lambda tag, header, body: None if tag == 12 else (tag, body))
+        stripped = Swf(out.getvalue())
+        self.assertEqual([], stripped.search_tags('DoAction'))
+        self.assertEqual(out.getvalue(), stripped.write())
+
+    def test_iter_tags(self):
+        params = open('sample/params/params.swf').read()
+        cws = Swf(params).write(compress=True)
+        tags = [(tag, body) for tag, header, body in iter_tags(StringIO(params))]
+        self.assertEqual(0, tags[-1][0])
+        self.assertEqual(tags, [(tag, body) for tag, header, body in iter_tags(StringIO(cws))])
+
+        head, f = read_swf_head(StringIO(cws))
+        self.assertEqual(tags, [(tag, body) for tag, header, body in iter_tags(f, head)])
+        # ヘッダーだけ読んで展開していない fileobj や、途中までのヘッダーは受け付けない
+        self.assertRaises(InvalidSWF, iter_tags, StringIO(cws[len(head):]), head)
+        self.assertRaises(InvalidSWF, iter_tags, StringIO(params[8:]), params[:8])
+        self.assertRaises(InvalidSWF, iter_tags, StringIO(params[8:]))
+
+    def test_rewrite_tags_unseekable(self):
+        class Body(object):
+            "write しかできない出力先 (socket や WSGI の write など)"
+            def __init__(self):
+                self.chunks = []
+            def write(self, chunk):
+                self.chunks.append(chunk)
+        params = open('sample/params/params.swf').read()
+        for swf in (params, Swf(params).write(compress=True)):
+            body = Body()
+            rewrite_tags(StringIO(swf), body,
+                         lambda tag, header, b: None if tag == 12 else (tag, b))
+            out = StringIO()
+            rewrite_tags(StringIO(swf), out,
+                         lambda tag, header, b: None if tag == 12 else (tag, b))
+            self.assertEqual(out.getvalue(), ''.join(body.chunks))
+
+    def test_write_chunks(self):
+        params = open('sample/params/params.swf').read()
+        swf = Swf(params)
+        swf.inject_params({'a': 'hoge', 'b': 'fuga'})
+        out = StringIO()
+        swf.write(out)
+        self.assertEqual(create_swf(params, {'a': 'hoge', 'b': 'fuga'}), out.getvalue())
+        self.assertEqual(out.getvalue(), ''.join(map(str, swf.iter_chunks())))
+
+        # 変更していないタグは元の SWF をコピーせずに参照する
+        for kwargs in ({}, {'LAZY': True}):
+            swf = Swf(params, **kwargs)
+            chunks = list(swf.iter_chunks())
+            self.assertEqual(params, ''.join(map(str, chunks)))
+            self.assertEqual([buffer], list(set(type(chunk) for chunk in chunks[1:])))
+            swf.search_tags('DoAction')[0].value = swf.search_tags('DoAction')[0].value
+            self.assertEqual(params, swf.write())
+
+    def test_compressed_swf(self):
+        tank = open('sample/mc/tank.swf').read()
+        cws = 'CWS' + tank[3:8] + zlib.compress(tank[8:])
+        swf = Swf(cws)
+        self.assertEqual(cws, swf.write())
+        self.assertEqual(tank, swf.write(compress=False))
+        self.assertEqual(cws, Swf(tank).write(compress=True))
+        self.assertEqual(
+            'CWS' + tank[3:8] + zlib.compress(tank[8:], 1),
+            ''.join(Swf(tank).iter_chunks(compress=True, level=1)))
+
+        out = StringIO()
+        rewrite_tags(StringIO(cws), out, lambda tag, header, body: (tag, body))
+        self.assertEqual(cws, out.getvalue())
+
+    def test_precompressed_swf(self):
+        params = open('sample/params/params.swf').read()
+        cws = 'CWS' + params[3:8] + zlib.compress(params[8:])
+        for base in (params, cws):
+            template = PrecompressedSwf(base)
+            for d in ({}, {'a': 'hoge', 'b': 'fuga'}):
+                self.assertEqual(
+                    decompress(create_swf(base, d)),
+                    decompress(template.create_swf(d)))
+        self.assertEqual(create_swf(params, {'a': 'hoge'}),
+                         PrecompressedSwf(params).create_swf({'a': 'hoge'}))
+
+    def test_definition_tag_hash(self):
+        dt = self.swf_bitmap.character_dict[7]
+        self.assertEqual(None, dt._hash)
+        md5_hash = dt.hash
+        self.assertEqual(md5_hash, dt.copy().hash)
+        dt.set_character_id(100)
+        self.assertEqual(None, dt._hash)
+        self.assertEqual(md5_hash, dt.hash)
+        try:
+            structure.set_hash_function(structure.crc32_digest)
+            self.assertNotEqual(md5_hash, dt.hash)
+        finally:
+            structure.set_hash_function(structure.md5_digest)
+        self.assertEqual(md5_hash, dt.hash)
+
+    def test_selective_parse(self):
+        params = open('sample/params/params.swf').read()
+        swf = Swf(params, parse=())
+        self.assertEqual([], swf.search_tags('PlaceObject2'))
+        self.assertEqual(params, swf.write())
+
+        tank = Swf.open('sample/mc/tank.swf', parse=('PlaceObject2', 'DefineSprite'))
+        self.assertEqual([], tank.search_tags('DefineShape'))
+        self.assertEqual(
+            self.swf_tank.get_movie_clip('kombu').translate,
+            tank.get_movie_clip('kombu').translate)
+        self.assertEqual(sorted(self.swf_tank.character_dict), sorted(tank.character_dict))
+
     def test_copy_swf(self):
         c_tank = self.swf_tank.copy()
         c_bitmap = self.swf_bitmap.copy()
@@ -40,6 +40,10 @@ class PlaceObject2DoesNotExist(Exception): pass
 
 # 不正なキャラクター ID に関するエラー
 class InvalidCharacterId(Exception): pass
+# 新しい character_id を振れなくなった場合のエラー
+class CharacterIdExhausted(Exception): pass
+# DefineSprite が自身を (間接的に) 配置している場合のエラー
+class CircularReference(Exception): pass
 
 # 文字列の最後に \0 (\x00) がない場合のエラー
 class NullCharacterDoesNotExist(Exception): pass
@@ -50,7 +54,8 @@ class InvalidSWF(Exception): pass
 
 
 def is_valid_swf(swf):
-    if swf[:4] != 'FWS\x04':
+    "非圧縮 (FWS) と zlib 圧縮 (CWS) の Flash Lite 1.1 を受け付ける"
+    if swf[:4] not in ('FWS\x04', 'CWS\x04'):
         if swf[:3] in ('FWS', 'CWS') and swf[3] != '\x04':
             raise InvalidSWF("Not Flash Lite 1.1 (Version: %d)" % ord(swf[3]))
         else:
@@ -27,8 +27,12 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
+import zlib
+import tempfile
+from array import array
 from structure import *
-from utils import le2byte, le4byte
+from utils import _h16, _h32, le2byte, le4byte, view, _oct_ceil
+from tomato.exceptions_tomato import InvalidSWF, is_valid_swf
 
 
 SWF_TAG = {
@@ -59,6 +63,58 @@ SWF_TAG = {
     88: DefineFontName,
     }
 
+TAG_CODES = dict((klass.__name__, tag) for tag, klass in SWF_TAG.items())
+
+# character_id を持つタグ
+DEFINITION_TAGS = frozenset(
+    tag for tag, klass in SWF_TAG.items() if issubclass(klass, DefinitionTag))
+
+
+def get_tag_codes(tags):
+    """
+    タグ番号, クラス, クラス名の並びをタグ番号の set にする
+    クラスの場合はそのサブクラスのタグも含める (ex. DefinitionTag)
+    """
+    ret = set()
+    for t in tags:
+        if isinstance(t, int):
+            ret.add(t)
+        elif isinstance(t, basestring):
+            ret.add(TAG_CODES[t])
+        else:
+            ret.update(tag for tag, klass in SWF_TAG.items() if issubclass(klass, t))
+    return frozenset(ret)
+
+
+def get_block_class(tag, swf=None):
+    """
+    tag に対応するクラスを返す
+    Swf(value, parse=...) で指定されていないタグは中身をパースせず、
+    DefinitionTag (character_id のみ) か SwfBlock として扱う
+    """
+    if swf and swf.flag['PARSE'] is not None and tag not in swf.flag['PARSE']:
+        if tag in DEFINITION_TAGS:
+            return DefinitionTag
+        return SwfBlock
+    return SWF_TAG.get(tag, SwfBlock)
+
+
+def make_swfblock(tag, block_len, content_offset, value, base_block=None, swf=None):
+    args = [tag, block_len, content_offset, value, base_block, swf]
+    # swf が無い場合は base_block の swf を見る
+    return get_block_class(tag, swf or (base_block and base_block.swf))(*args)
+
+
+def read_tag_header(value, offset):
+    "offset にあるタグのヘッダーを読み、(tag, length, header_size) を返す"
+    tag = le2byte(value[offset:(offset + 2)])
+    block_len = tag & 0x3f
+    header_size = 2
+    if block_len == 0x3f:
+        block_len = le4byte(value[(offset + 2):(offset + 6)])
+        header_size = 6
+    return tag >> 6, block_len, header_size
+
 
 class SwfBlockParser(object):
     def __init__(self, value, base_block=None, swf=None):
@@ -87,18 +143,13 @@ class SwfBlockParser(object):
         content_offset = self.offset - block_start
         self.offset += block_len
 
-        args = [
+        return make_swfblock(
             tag,
             block_len,
             content_offset,
-            self.value[block_start:self.offset],
+            view(self.value, block_start, self.offset - block_start),
             self.base_block,
-            self.swf]
-
-        if tag in SWF_TAG:
-            return SWF_TAG[tag](*args)
-        else:
-            return SwfBlock(*args)
+            self.swf)
 
     def read(self, num):
         "num byte(s) ずつ swf を読み出す"
@@ -106,6 +157,502 @@ class SwfBlockParser(object):
         return self.value[self.offset - num: self.offset]
 
 
+class TagTable(object):
+    """
+    タグのヘッダーだけを読み込んだ表
+    (tag code, offset, length, header size) をそれぞれ array で保持する
+    """
+    __slots__ = ('value', 'tags', 'offsets', 'lengths', 'header_sizes')
+
+    def __init__(self, value):
+        self.value = value
+        self.tags = array('H')
+        self.offsets = array('L')
+        self.lengths = array('L')
+        self.header_sizes = array('B')
+
+        offset = 0
+        while True:
+            tag, block_len, header_size = read_tag_header(value, offset)
+            self.tags.append(tag)
+            self.offsets.append(offset)
+            self.lengths.append(block_len)
+            self.header_sizes.append(header_size)
+            offset += header_size + block_len
+            if tag == 0:
+                break
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getitem__(self, row):
+        return (self.tags[row], self.offsets[row],
+                self.lengths[row], self.header_sizes[row])
+
+    def size(self, row):
+        "ヘッダーを含めたタグのバイト数"
+        return self.header_sizes[row] + self.lengths[row]
+
+    def get_view(self, row):
+        return view(self.value, self.offsets[row], self.size(row))
+
+    def get_value(self, row):
+        offset = self.offsets[row]
+        return self.value[offset:(offset + self.size(row))]
+
+    def character_id(self, row):
+        offset = self.offsets[row] + self.header_sizes[row]
+        return le2byte(self.value[offset:(offset + 2)])
+
+
+class LazyBlocks(object):
+    """
+    SwfBlockParser(...).blocks の代わりに用いる list
+    最初は TagTable の行番号だけを持ち、
+    参照されたタグだけをその時に SwfBlock にする
+    """
+    def __init__(self, value, base_block=None, swf=None, table=None):
+        self.table = table or TagTable(value)
+        self.base_block = base_block
+        self.swf = swf
+        self.items = range(len(self.table))   # 行番号 or SwfBlock
+        self.built = {}   # 行番号 -> SwfBlock
+
+    def build(self, row):
+        "表の row 行目のタグを SwfBlock にする"
+        block = self.built.get(row)
+        if block is None:
+            tag, offset, block_len, header_size = self.table[row]
+            block = make_swfblock(
+                tag,
+                block_len,
+                header_size,
+                self.table.get_view(row),
+                self.base_block,
+                self.swf)
+            self.built[row] = block
+        return block
+
+    def resolve(self, item):
+        "行番号のタグが既に SwfBlock になっていれば (character_dict 経由など) それを返す"
+        if isinstance(item, int):
+            return self.built.get(item, item)
+        return item
+
+    def get(self, index):
+        item = self.items[index]
+        if isinstance(item, int):
+            item = self.items[index] = self.build(item)
+        return item
+
+    def is_item(self, item, block):
+        return item is block or \
+            (isinstance(item, int) and self.built.get(item) is block)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        for i in xrange(len(self.items)):
+            yield self.get(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get(i) for i in xrange(*index.indices(len(self.items)))]
+        return self.get(index)
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(i, j))
+
+    def __setitem__(self, index, block):
+        self.items[index] = block
+
+    def __delitem__(self, index):
+        del self.items[index]
+
+    def __contains__(self, block):
+        for item in self.items:
+            if self.is_item(item, block):
+                return True
+        return False
+
+    def index(self, block):
+        for i, item in enumerate(self.items):
+            if self.is_item(item, block):
+                return i
+        raise ValueError('%r is not in blocks' % block)
+
+    def remove(self, block):
+        del self.items[self.index(block)]
+
+    def insert(self, index, block):
+        self.items.insert(index, block)
+
+    def append(self, block):
+        self.items.append(block)
+
+    def filter_tags(self, tags):
+        "tags に含まれるタグだけを SwfBlock にして返す"
+        ret = []
+        for i, item in enumerate(self.items):
+            if isinstance(item, int):
+                if self.table.tags[item] not in tags:
+                    continue
+                item = self.get(i)
+            elif item.tag not in tags:
+                continue
+            ret.append(item)
+        return ret
+
+    def iter_values(self):
+        "SwfBlock を作らずに各タグのバイト列を返す"
+        for item in self.items:
+            item = self.resolve(item)
+            if isinstance(item, int):
+                yield self.table.get_value(item)
+            else:
+                yield item.value
+
+    def iter_buffers(self):
+        "iter_values と同じだが、変更していないタグは元の value をコピーせずに参照する"
+        for item in self.items:
+            item = self.resolve(item)
+            if isinstance(item, int):
+                yield self.table.get_view(item)
+            else:
+                yield item.buf
+
+    def iter_lengths(self):
+        for item in self.items:
+            item = self.resolve(item)
+            if isinstance(item, int):
+                yield self.table.size(item)
+            else:
+                yield len(item)
+
+    def iter_character_ids(self):
+        "(character_id, 行番号 or DefinitionTag) を返す"
+        for item in self.items:
+            item = self.resolve(item)
+            if isinstance(item, int):
+                if self.table.tags[item] in DEFINITION_TAGS:
+                    yield self.table.character_id(item), item
+            elif isinstance(item, DefinitionTag):
+                yield item.character_id, item
+
+    def copy(self, swf=None, base_block=None):
+        "まだ SwfBlock になっていないタグは TagTable を共有する"
+        new = LazyBlocks(None, base_block, swf, self.table)
+        new.items = [
+            item if isinstance(item, int) else item.copy(swf, base_block=base_block)
+            for item in map(self.resolve, self.items)]
+        return new
+
+
+class LazyCharacterDict(dict):
+    """
+    character_id -> DefinitionTag の辞書
+    値は LazyBlocks の行番号で持ち、取り出したときに SwfBlock にする
+    """
+    def __init__(self, blocks):
+        dict.__init__(self, blocks.iter_character_ids())
+        self.blocks = blocks
+
+    def __getitem__(self, character_id):
+        dt = dict.__getitem__(self, character_id)
+        if isinstance(dt, int):
+            dt = self.blocks.build(dt)
+            dict.__setitem__(self, character_id, dt)
+        return dt
+
+    def get(self, character_id, default=None):
+        if character_id in self:
+            return self[character_id]
+        return default
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def itervalues(self):
+        for k in self.keys():
+            yield self[k]
+
+    def iteritems(self):
+        for k in self.keys():
+            yield k, self[k]
+
+
+def get_block_head(blocks, index):
+    """
+    blocks[index] の (タグ番号, 内容の先頭の UI16) を返す
+    内容が 2 byte 未満なら UI16 は None. LazyBlocks の場合は SwfBlock を作らない
+    """
+    if isinstance(blocks, LazyBlocks):
+        item = blocks.resolve(blocks.items[index])
+        if isinstance(item, int):
+            if blocks.table.lengths[item] < 2:
+                return blocks.table.tags[item], None
+            return blocks.table.tags[item], blocks.table.character_id(item)
+    else:
+        item = blocks[index]
+    offset = item.content_offset
+    if len(item.buf) < offset + 2:
+        return item.tag, None
+    return item.tag, le2byte(item.buf[offset:(offset + 2)])
+
+
+def iter_block_values(blocks):
+    "各タグのバイト列を返す. LazyBlocks の場合は SwfBlock を作らない"
+    if isinstance(blocks, LazyBlocks):
+        return blocks.iter_values()
+    return (block.value for block in blocks)
+
+
+def iter_block_buffers(blocks):
+    """
+    各タグのバイト列を str または buffer で返す
+    変更していないタグは読み込んだ SWF をコピーせずに参照する
+    """
+    if isinstance(blocks, LazyBlocks):
+        return blocks.iter_buffers()
+    return (block.buf for block in blocks)
+
+
+def iter_block_lengths(blocks):
+    if isinstance(blocks, LazyBlocks):
+        return blocks.iter_lengths()
+    return (len(block) for block in blocks)
+
+
+def copy_blocks(blocks, swf=None, base_block=None):
+    if isinstance(blocks, LazyBlocks):
+        return blocks.copy(swf, base_block)
+    return map(lambda b: b.copy(swf, base_block=base_block), blocks)
+
+
+def read_bytes(fileobj, num):
+    "fileobj から num byte 読み込む. socket 等で分割して返ってきても num byte まで読む"
+    ret = fileobj.read(num)
+    while len(ret) < num:
+        s = fileobj.read(num - len(ret))
+        if not s:
+            raise InvalidSWF('Unexpected end of file (%d < %d)' % (len(ret), num))
+        ret += s
+    return ret
+
+
+# zlib で分割して展開, 圧縮する際のバイト数
+ZLIB_CHUNK_SIZE = 64 * 1024
+
+
+def iter_decompress(value, offset=8):
+    "value[offset:] を ZLIB_CHUNK_SIZE ずつ展開して返す (CWS)"
+    d = zlib.decompressobj()
+    for pos in xrange(offset, len(value), ZLIB_CHUNK_SIZE):
+        yield d.decompress(view(value, pos, ZLIB_CHUNK_SIZE))
+    yield d.flush()
+
+
+def decompress_swf(value):
+    "CWS を展開して、先頭 8 byte (magic, version, file_length) はそのままの str にする"
+    return ''.join([value[:8]] + list(iter_decompress(value)))
+
+
+def iter_compress(chunks, level=zlib.Z_DEFAULT_COMPRESSION):
+    "chunks を順番に圧縮して返す. 全体を結合した文字列は作らない"
+    c = zlib.compressobj(level)
+    for chunk in chunks:
+        ret = c.compress(chunk)
+        if ret:
+            yield ret
+    yield c.flush()
+
+
+class ZlibReader(object):
+    "fileobj を展開しながら read する (CWS の 9 byte 目以降)"
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.d = zlib.decompressobj()
+        self.buf = ''
+        self.pos = 0
+
+    def read(self, num):
+        while len(self.buf) - self.pos < num and self.d is not None:
+            s = self.fileobj.read(ZLIB_CHUNK_SIZE)
+            if s:
+                s = self.d.decompress(s)
+            else:
+                s = self.d.flush()
+                self.d = None
+            self.buf = self.buf[self.pos:] + s
+            self.pos = 0
+        ret = self.buf[self.pos:self.pos + num]
+        self.pos += len(ret)
+        return ret
+
+
+def read_swf_head(fileobj):
+    """
+    File Header (RECT, frame rate, frame count まで) を読み込み、
+    (head, タグを読み込むための fileobj) を返す
+    CWS の場合は fileobj を ZlibReader で包む
+    """
+    head = read_bytes(fileobj, 8)
+    is_valid_swf(head)
+    if head[:3] == 'CWS':
+        fileobj = ZlibReader(fileobj)
+    head += read_bytes(fileobj, 1)
+    nbits = ord(head[8]) >> 3
+    head += read_bytes(fileobj, _oct_ceil(5 + nbits * 4) - 1 + 4)
+    return head, fileobj
+
+
+def make_tag_header(tag, length, long_header=False):
+    "TagCodeAndLength を作る. length が 63 以上であれば long 形式にする"
+    if long_header or length >= 0x3f:
+        return _h16((tag << 6) + 0x3f) + _h32(length)
+    return _h16((tag << 6) + length)
+
+
+def check_swf_head(head, fileobj):
+    """
+    read_swf_head が返した (head, fileobj) であることを確かめる
+    head が File Header 全体でない場合や、CWS なのに fileobj が展開されていない場合は
+    InvalidSWF を送出する
+    """
+    is_valid_swf(head)
+    if len(head) < 9 or len(head) != 8 + _oct_ceil(5 + (ord(head[8]) >> 3) * 4) + 4:
+        raise InvalidSWF('Incomplete File Header (len: %d)' % len(head))
+    if head[:3] == 'CWS' and not isinstance(fileobj, ZlibReader):
+        raise InvalidSWF('CWS tags must be read from the fileobj returned by read_swf_head')
+
+
+def iter_tags(fileobj, head=None):
+    """
+    fileobj からタグを 1 つずつ読み込み (tag, header, body) を返す
+    End タグを返したところで終了する
+    一度に読み込むのは 1 タグ分だけなので、大きな SWF でもメモリを使わない
+
+    head が None の場合、fileobj は SWF の先頭を指していること.
+    File Header はここで読み込んで検証する (CWS も展開する)
+    既に read_swf_head で File Header を読んでいる場合は、
+    その戻り値の (head, fileobj) をそのまま渡すこと
+    """
+    if head is None:
+        head, fileobj = read_swf_head(fileobj)
+    else:
+        check_swf_head(head, fileobj)
+    return _iter_tags(fileobj)
+
+
+def _iter_tags(fileobj):
+    "File Header の直後から End タグまでを読み込む"
+    while True:
+        header = read_bytes(fileobj, 2)
+        tag_code_and_length = le2byte(header)
+        block_len = tag_code_and_length & 0x3f
+        if block_len == 0x3f:
+            long_length = read_bytes(fileobj, 4)
+            header += long_length
+            block_len = le4byte(long_length)
+        tag = tag_code_and_length >> 6
+        yield tag, header, read_bytes(fileobj, block_len)
+        if tag == 0:
+            break
+
+
+def is_seekable(f):
+    "f が seek できるかどうか. pipe, socket や write だけのオブジェクトは seek できない"
+    try:
+        f.seek(0, 1)   # 位置は変えない
+    except (AttributeError, IOError, OSError):
+        return False
+    return True
+
+
+class SwfTagWriter(object):
+    """
+    iter_tags に対応する、タグを 1 つずつ f に書き出すクラス
+    close() の際に File Header の file_length を書き直す
+    f が seek できない場合 (pipe, socket, WSGI など) は一時ファイルに書き出しておき、
+    close() の際に f に書き出す
+    swf_head が CWS であれば 9 byte 目以降を level で圧縮しながら書き出す
+    """
+    def __init__(self, f, swf_head, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.out = None
+        if not is_seekable(f):
+            self.out, f = f, tempfile.SpooledTemporaryFile(ZLIB_CHUNK_SIZE * 16)
+        self.f = f
+        self.start = f.tell()
+        self.swf_head = swf_head
+        self.file_length = 8
+        self.compressor = None
+        f.write(swf_head[:8])
+        if swf_head[:3] == 'CWS':
+            self.compressor = zlib.compressobj(level)
+        self.write(swf_head[8:])
+
+    def write(self, value):
+        "ヘッダーを含むタグをそのまま書き出す"
+        if self.compressor:
+            self.f.write(self.compressor.compress(value))
+        else:
+            self.f.write(value)
+        self.file_length += len(value)
+
+    def write_tag(self, tag, body, header=None):
+        if header is None:
+            header = make_tag_header(tag, len(body))
+        self.write(header)
+        self.write(body)
+
+    def close(self):
+        if self.compressor:
+            self.f.write(self.compressor.flush())
+            self.compressor = None
+        self.f.seek(self.start + 4)
+        self.f.write(_h32(self.file_length))
+        self.f.seek(0, 2)
+        if self.out is not None:
+            self.f.seek(0)
+            while True:
+                chunk = self.f.read(ZLIB_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.out.write(chunk)
+            self.f.close()
+            self.f = self.out
+            self.out = None
+
+
+def rewrite_tags(in_file, out_file, func):
+    """
+    in_file の各タグを func(tag, header, body) に渡し、
+    その戻り値に応じて out_file に書き出す
+      None        -> タグを削除する
+      (tag, body) -> タグを置き換える (body が同じであればヘッダーもそのまま)
+    Swf.blocks を作らずに、1 タグずつ処理する
+    CWS はそのまま CWS で書き出す
+    """
+    head, in_file = read_swf_head(in_file)
+    writer = SwfTagWriter(out_file, head)
+    for tag, header, body in iter_tags(in_file, head):
+        ret = func(tag, header, body)
+        if ret is None:
+            continue
+        new_tag, new_body = ret
+        if new_tag == tag and new_body is body:
+            writer.write_tag(tag, body, header)
+        else:
+            writer.write_tag(
+                new_tag, new_body, make_tag_header(new_tag, len(new_body), len(header) == 6))
+    writer.close()
+    return writer.file_length
+
+
 def deserialize_blocks(blocks_tpl, serializer_version, swf=None, base_block=None):
     blocks = []
     for tpl in blocks_tpl:
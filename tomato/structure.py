@@ -28,13 +28,12 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 import hashlib
+import zlib
 import parser
 
-from bitarray import bitarray
-from collections import defaultdict
+from array import array
 from tomato.utils import _h32, _h16, le2byte, le4byte, \
-     flatten_defaultdict_set, \
-     Bits, SignedBits as SB, s2b, b2i, _oct, \
+     Bits, view, BitReader, \
      MATRIX, CXFORMWITHALPHA, RECT, \
      SERIALIZER_MOVIECLIP_V1 as MOVIECLIP_V1
 from tomato.exceptions_tomato import *
@@ -43,27 +42,68 @@ from tomato.exceptions_tomato import *
 DEBUG = False
 
 
-class StreamIO(object):
-    __slots__ = ('value', 'bitvalue', 'pos', 'bpos')
+def md5_digest(value):
+    return hashlib.md5(value).hexdigest()
+
+
+def crc32_digest(value):
+    "md5 より高速だが衝突しやすいので、長さも含めておく"
+    return '%08x:%x' % (zlib.crc32(value) & 0xffffffff, len(value))
+
+
+# DefinitionTag.hash を計算する関数 (buffer -> digest)
+hash_function = md5_digest
+
+
+def set_hash_function(func):
+    """
+    DefinitionTag.hash の計算に用いる関数を変更する
+    例: set_hash_function(crc32_digest)
+        set_hash_function(lambda v: hashlib.sha256(v).hexdigest())
+    """
+    global hash_function
+    hash_function = func
+
+
+class StreamIO(BitReader):
+    """
+    value は str, buffer, mmap のいずれかをコピーせずに保持する (buf)
+    value を書き換えるまでは元のバッファを共有する
+    bit 単位の読み込みは BitReader に任せる
+    """
+    __slots__ = ('_value', 'pos')
     
     def __init__(self, value=""):
-        self.value = value
-        self.bitvalue = s2b(value)
+        self.buf = value
+        self._value = value if isinstance(value, str) else None
         self.pos = 0
         self.bpos = 0   # bit 毎に読み込むための offset
 
+    @property
+    def value(self):
+        if self._value is None:
+            # バッファを参照している場合は呼ばれた時だけ str にする
+            return self.buf[:]
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self.buf = self._value = value
+
+    def get_view(self, start=0, end=None):
+        "value[start:end] をコピーせずに参照する"
+        if end is None:
+            return view(self.buf, start)
+        return view(self.buf, start, end - start)
+
     def read(self, num):
         self.align_byte()
         self.pos += num
         self.bpos = self.pos * 8
-        if len(self.value) < self.pos:
+        if len(self.buf) < self.pos:
             raise StringError('%s - len(value): %d < pos: %d' % (
-                self.__class__.__name__, len(self.value), self.pos))
-        return self.value[self.pos - num: self.pos]
-
-    def read_bits(self, num):
-        self.bpos += num
-        return self.bitvalue[self.bpos - num: self.bpos]
+                self.__class__.__name__, len(self.buf), self.pos))
+        return self.buf[self.pos - num: self.pos]
 
     def align_pos(self):
         self.pos = self.bpos / 8
@@ -72,9 +112,6 @@ class StreamIO(object):
         self.pos = num
         self.bpos = num * 8
     
-    def get_bits(self, num):
-        return self.bitvalue[self.bpos: self.bpos + num]
-        
     def read_string(self):
         ret_string = ""
         s = self.read(1)
@@ -86,7 +123,7 @@ class StreamIO(object):
         return ret_string
 
     def align_byte(self):
-        self.bpos = _oct(self.bpos)
+        BitReader.align_byte(self)
         self.pos = self.bpos / 8
 
 
@@ -96,10 +133,7 @@ class SwfBlock(StreamIO):
         }
 
     def __init__(self, tag, length, content_offset, value, base_block, swf=None, IS_PARSE=True):
-        if IS_PARSE:
-            StreamIO.__init__(self, value)
-        else:
-            self.value = value
+        StreamIO.__init__(self, value)
         self.tag = tag
         self.length = length
         self.content_offset = content_offset
@@ -109,7 +143,7 @@ class SwfBlock(StreamIO):
         self.IS_PARSE = IS_PARSE
 
     def __len__(self):
-        return len(self.value)
+        return len(self.buf)
         
     def __str__(self):
         return "%s(%d) - len:%d" % (self._get_class_name(), self.tag, self.length)
@@ -138,7 +172,7 @@ class SwfBlock(StreamIO):
             self.tag,
             self.length,
             self.content_offset,
-            self.value,
+            self.buf,
             base_block,
             swf,
             False)    # IS_PARSE
@@ -149,7 +183,7 @@ class SwfBlock(StreamIO):
         タグ（block）の length を変える. length の長さによって形式が変わる
         See swf_file_format_spec_v10.pdf (p.27)
         """
-        old_tag_code_and_length = le2byte(self.value[:2])
+        old_tag_code_and_length = le2byte(self.buf[:2])
         length = old_tag_code_and_length & 0x3f
 
         if length != 63:
@@ -157,14 +191,14 @@ class SwfBlock(StreamIO):
             short. TagCodeAndLength は 2 byte のみ
             """
             tag_code_and_length = (self.tag << 6) + num
-            self.value = _h16(tag_code_and_length) + self.value[2:]
+            self.value = _h16(tag_code_and_length) + self.buf[2:]
         else:
             """
             large. TagCodeAndLength は 2 byte + 4 byte
             後ろの 4 byte の length を変えれば良い
             """
-            self.value = self.value[:(self.content_offset - 4)] + _h32(num) + \
-                self.value[self.content_offset:]
+            self.value = self.buf[:(self.content_offset - 4)] + _h32(num) + \
+                self.buf[self.content_offset:]
         self.length = num
 
     def serialize(self, serializer_version):
@@ -174,6 +208,48 @@ class SwfBlock(StreamIO):
         return tuple(ret)
 
 
+def replace_uint16s(block, offsets, mapping):
+    """
+    block.buf の offsets [(位置, character_id), ...] にある character_id を
+    mapping に従って置き換える. 置き換えた場合は True
+    """
+    value = block.buf
+    replaced = False
+    for offset, ch_id in offsets:
+        if ch_id in mapping:
+            value = value[:offset] + _h16(mapping[ch_id]) + value[(offset + 2):]
+            replaced = True
+    if replaced:
+        block.value = value
+    return replaced
+
+
+def read_placed_id(block):
+    """
+    PlaceObject2, PlaceObject, StartSound が配置する character_id の (位置, character_id)
+    配置しない場合は None. パースしていない SwfBlock でも buf から読む
+    """
+    offset = block.content_offset
+    if block.tag == 26:
+        if not ord(block.buf[offset]) & 0x02:   # PlaceFlagHasCharacter
+            return None
+        offset += 3   # PlaceFlags, Depth
+    elif block.tag not in (4, 15):
+        return None
+    return offset, le2byte(block.buf[offset:(offset + 2)])
+
+
+def replace_placed_id(block, mapping):
+    "PlaceObject2, PlaceObject, StartSound が配置する character_id を置き換える"
+    if isinstance(block, PlaceObject2):
+        if block.target_character_id in mapping:
+            block.set_target_character_id(mapping[block.target_character_id])
+            return True
+        return False
+    placed = read_placed_id(block)
+    return placed is not None and replace_uint16s(block, [placed], mapping)
+
+
 class DefinitionTag(SwfBlock):
     """
     Flash の Definition Tag のクラス
@@ -192,17 +268,37 @@ class DefinitionTag(SwfBlock):
 
     def __init__(self, *args):
         SwfBlock.__init__(self, *args)
+        self._hash = None   # (hash_function, digest)
 
         if self.IS_PARSE:
             # Definition Tag には最初２バイトに必ずユニークな character_id が存在している
             self.character_id_offset = self.pos
-            self.character_id = le2byte(self.value[self.pos:(self.pos + 2)])
+            self.character_id = le2byte(self.buf[self.pos:(self.pos + 2)])
 
-            # ハッシュの生成
+    @property
+    def value(self):
+        return StreamIO.value.fget(self)
+
+    @value.setter
+    def value(self, value):
+        StreamIO.value.fset(self, value)
+        self._hash = None   # 内容が変わったのでハッシュを計算し直す
+        if self.swf is not None:
+            self.swf.index_update(self)
+
+    @property
+    def hash(self):
+        "character_id 以降の内容のハッシュ値. 最初に参照された時に計算する"
+        if self._hash is None or self._hash[0] is not hash_function:
             self.generate_hash()
+        return self._hash[1]
+
+    @hash.setter
+    def hash(self, digest):
+        self._hash = (hash_function, digest)
 
     def generate_hash(self):
-        self.hash = hashlib.md5(self.value[(self.pos + 2):]).hexdigest()
+        self.hash = hash_function(self.get_view(self.content_offset + 2))
 
     def copy(self, swf=None, base_block=None):
         if not base_block:
@@ -212,21 +308,46 @@ class DefinitionTag(SwfBlock):
             self.tag,
             self.length,
             self.content_offset,
-            self.value,
+            self.buf,
             base_block,
             swf,
             False)    # IS_PARSE
-        new.hash = self.hash
+        new._hash = self._hash
         new.character_id = self.character_id
         new.character_id_offset = self.character_id_offset
         return new
 
+    def reference_offsets(self):
+        """
+        この DefinitionTag が参照している character_id の (buf での位置, character_id) の list
+        参照先を調べられないタグは None
+        """
+        return None
+
+    def references(self):
+        "参照している character_id の list. 調べられない場合は None"
+        offsets = self.reference_offsets()
+        if offsets is None:
+            return None
+        ret = []
+        for offset, ch_id in offsets:
+            if ch_id not in ret:
+                ret.append(ch_id)
+        return ret
+
+    def replace_references(self, mapping):
+        """
+        参照している character_id を mapping {古い ID: 新しい ID} に従って置き換える
+        置き換えた場合は True
+        """
+        return replace_uint16s(self, self.reference_offsets() or (), mapping)
+
     def set_character_id(self, num):
         "CharacterId を置き換える"
         assert isinstance(num, int)
         self.value = \
-            self.value[:self.character_id_offset] + _h16(num) + \
-            self.value[(self.character_id_offset + 2):]
+            self.buf[:self.character_id_offset] + _h16(num) + \
+            self.buf[(self.character_id_offset + 2):]
         self.character_id = num
     
     def deserialize(self, serializer_version, tpl):
@@ -245,6 +366,15 @@ class DefineSound(DefinitionTag):    # Tag type: 14
     def __init__(self, *args):
         DefinitionTag.__init__(self, *args)
 
+    def reference_offsets(self):
+        return []
+
+
+# DefineSprite 内にあって character_id を参照しないタグ
+# (End, ShowFrame, RemoveObject, DoAction, SoundStreamHead, SoundStreamBlock,
+#  RemoveObject2, FrameLabel, SoundStreamHead2)
+SPRITE_CONTROL_TAGS = frozenset([0, 1, 5, 12, 18, 19, 28, 43, 45])
+
 
 class DefineSprite(DefinitionTag):    # Tag type: 39
     _serialize_attr_ = {
@@ -276,28 +406,71 @@ class DefineSprite(DefinitionTag):    # Tag type: 39
         self.framecount_offset = self.pos
         self.framecount = le2byte(self.read(2))
 
+        # 内部のタグは親のバッファをコピーせずに参照する
         self.blocks_offset = self.pos
-        self.blocks = parser.SwfBlockParser(
-            self.value[self.pos:],
-            base_block=self).blocks   # ここからタグが続く        
+        # 内部のタグも swf を持ち、変更を Swf の索引に伝える
+        if self.swf and self.swf.flag['LAZY']:
+            self.blocks = parser.LazyBlocks(
+                self.get_view(self.pos),
+                base_block=self,
+                swf=self.swf)
+        else:
+            self.blocks = parser.SwfBlockParser(
+                self.get_view(self.pos),
+                base_block=self,
+                swf=self.swf).blocks   # ここからタグが続く        
+
+    def references(self):
+        """
+        内部の PlaceObject2, PlaceObject, StartSound が参照している character_id
+        他に character_id を参照しうるタグがあれば None
+        """
+        ret = []
+        for block in self.blocks:
+            if block.tag in (4, 15, 26):
+                placed = read_placed_id(block)
+                if placed is not None and placed[1] not in ret:
+                    ret.append(placed[1])
+            elif block.tag not in SPRITE_CONTROL_TAGS:
+                return None
+        return ret
+
+    def replace_references(self, mapping):
+        "内部で配置している character_id を置き換えて、自分自身を更新する"
+        replaced = False
+        for block in self.blocks:
+            replaced |= replace_placed_id(block, mapping)
+        if replaced:
+            self.update_value()
+        return replaced
 
     def set_framecount(self, num):
         "Framecount を置き換える"
         self.value = \
-            self.value[:self.framecount_offset] + \
+            self.buf[:self.framecount_offset] + \
             _h16(num) + \
-            self.value[(self.framecount_offset + 2):]
+            self.buf[(self.framecount_offset + 2):]
         self.framecount = num
 
     def update_value(self):
         "blocks が更新されたときのために、自分自身を更新する"
-        self.value = self.value[:self.blocks_offset] + ''.join(map(lambda b: b.value, self.blocks))
+        if self.swf is not None and self.swf.dirty is not None:
+            # Swf.batch の中では印を付けるだけにして、抜ける時にまとめて更新する
+            self.swf.dirty.setdefault(id(self), self)
+            return
+        self.value = self.buf[:self.blocks_offset] + ''.join(parser.iter_block_values(self.blocks))
 
         "この tag 自体の length も変更する．ただし最初のタグと長さは含めない"
-        self.set_length(len(self.value) - self.content_offset)
+        self.set_length(len(self.buf) - self.content_offset)
+
+    def flush(self):
+        "Swf.batch の中で更新を待っていれば、先に更新する"
+        if self.swf is not None and self.swf.dirty and id(self) in self.swf.dirty:
+            self.swf.flush()
 
     def serialize(self, serializer_version):
         # シリアライズ関数を DefineSprite 専用にオーバーライドする
+        self.flush()
         ret = []
         for attr in self._serialize_attr_[serializer_version]:
             ret.append(getattr(self, attr))
@@ -322,22 +495,23 @@ class DefineSprite(DefinitionTag):    # Tag type: 39
 
     def copy(self, swf=None, base_block=None):
         # DefinitionTag は、hash, character_id, character_id_offset も保持する
+        self.flush()
         if not base_block:
             base_block = self.base_block
         new = self.__class__(
             self.tag,
             self.length,
             self.content_offset,
-            self.value,
+            self.buf,
             base_block,
             swf,
             False)    # IS_PARSE
-        new.hash = self.hash
+        new._hash = self._hash
         new.character_id = self.character_id
         new.character_id_offset = self.character_id_offset
 
         new.blocks_offset = self.blocks_offset
-        new.blocks = map(lambda b: b.copy(swf, base_block=new), self.blocks)
+        new.blocks = parser.copy_blocks(self.blocks, swf, base_block=new)
         return new
 
 
@@ -412,10 +586,9 @@ class MovieClip(object):
 
     def get_place_object2(self):
         if not self.place_object2:
-            for p in self.swf.search_tags('PlaceObject2'):
-                if p.target_character_id == self.define_sprite.character_id:
-                    self.place_object2 = p
-                    return
+            refs = self.swf.reference_index.get(self.define_sprite.character_id)
+            if refs:
+                self.place_object2 = refs[0][0]
 
     def copy_inside_definition_tags(self, new_swf, define_sprite):
         """
@@ -425,17 +598,20 @@ class MovieClip(object):
         # ID 更新用辞書
         update_character_dict = {}
         
-        # 全ての DefinitionTags'ID を queue に収集する
-        queue = self.swf.get_all_definition_tags(define_sprite, depth=1, dts=defaultdict(set))
+        # 全ての DefinitionTags'ID を深さ毎に queue に収集する
+        queue = self.swf.dependency_graph.layers(define_sprite)
         """
         new_swf 内に DefinitionTag があるかどうか調べて、
         ・無ければ   -> new_swf の blocks に追加して、新規IDを取得する
         ・存在すれば -> 既存ID を取得する
         """
-        for d in flatten_defaultdict_set(queue):
+        # new_swf にあったものは既に new_swf の ID を配置しているので更新しない
+        reused = set()
+        for d in sorted(ch_id for layer in queue.values() for ch_id in layer):
             ch_id = new_swf.get_same_definition_tag(self.swf.character_dict[d])
             if ch_id:
                 update_character_dict[d] = ch_id
+                reused.add(d)
             else:
                 new_dt_id = new_swf.insert_definition_tag(
                     new_dt=self.swf.character_dict[d],
@@ -449,8 +625,10 @@ class MovieClip(object):
         queue の中身は、階層の深さ毎に ID が set として記述されている
         深い階層から順番に update_value を行う
         """
-        for i in range(max(queue), 0, -1):
+        for i in sorted(queue, reverse=True):
             for q in queue[i]:
+                if q in reused:
+                    continue
                 ds = new_swf.character_dict[update_character_dict[q]]
                 if not isinstance(ds, DefineSprite):
                     continue
@@ -468,7 +646,8 @@ class MovieClip(object):
         define_sprite.update_value()
 
     def set_name(self, name):
-        self.place_object.set_name(name)
+        self.get_place_object2()
+        self.place_object2.set_name(name)
 
 
 def pixel2twip(num): return int(num * 20)
@@ -529,6 +708,27 @@ class DefineButton2(DefinitionTag):
     
     def parse(self):
         pass
+
+    def reference_offsets(self):
+        "BUTTONRECORD の CharacterID"
+        self.set_pos(self.content_offset + 2)
+        self.read(1)    # TrackAsMenu
+        self.read(2)    # ActionOffset
+        ret = []
+        while True:
+            flags = ord(self.read(1))
+            if flags == 0:   # CharacterEndFlag
+                break
+            if flags & 0x10:   # ButtonHasFilterList (SWF 8 or later)
+                return None
+            ret.append((self.pos, le2byte(self.read(2))))
+            self.read(2)    # PlaceDepth
+            MATRIX().parse(self)
+            self.align_byte()
+            CXFORMWITHALPHA().parse(self)
+            if flags & 0x20:   # ButtonHasBlendMode
+                self.read(1)
+        return ret
         
 
 class DefineBitsLossless2(DefinitionTag):
@@ -545,6 +745,9 @@ class DefineBitsLossless2(DefinitionTag):
             self.BitmapColorTableSize = ord(self.read(1))
         # self.ZlibBitmapData = ...
 
+    def reference_offsets(self):
+        return []
+
 
 class DefineBits(DefinitionTag):   # Tag type: 6
     def __init__(self, *args):
@@ -555,6 +758,9 @@ class DefineBits(DefinitionTag):   # Tag type: 6
         self.character_id = le2byte(self.read(2))    # CharacterID
         # self.JPEGData = self.read[self.offset:]
 
+    def reference_offsets(self):
+        return []
+
 
 class JPEGTables(SwfBlock):   # Tag type: 8
     def __init__(self, *args):
@@ -574,6 +780,35 @@ class DefineText(DefinitionTag):  # Tag type: 11
         # self.AdvanceBits = ord(self.read(1))
         # ...
 
+    def reference_offsets(self):
+        "TEXTRECORD の FontID"
+        self.set_pos(self.content_offset + 2)
+        RECT().parse(self)      # TextBounds
+        self.align_byte()
+        MATRIX().parse(self)    # TextMatrix
+        glyph_bits = ord(self.read(1))
+        advance_bits = ord(self.read(1))
+        ret = []
+        while True:
+            flags = ord(self.read(1))
+            if flags == 0:   # EndOfRecordsFlag
+                break
+            if flags & 0x08:   # StyleFlagsHasFont
+                ret.append((self.pos, le2byte(self.read(2))))
+            if flags & 0x04:   # StyleFlagsHasColor (RGB)
+                self.read(3)
+            if flags & 0x01:   # StyleFlagsHasXOffset
+                self.read(2)
+            if flags & 0x02:   # StyleFlagsHasYOffset
+                self.read(2)
+            if flags & 0x08:   # TextHeight
+                self.read(2)
+            glyph_count = ord(self.read(1))
+            # GLYPHENTRY は読み飛ばす
+            self.bpos += (glyph_bits + advance_bits) * glyph_count
+            self.align_byte()
+        return ret
+
 
 class DefineBitsJPEG2(DefinitionTag):
     def __init__(self, *args):
@@ -584,6 +819,9 @@ class DefineBitsJPEG2(DefinitionTag):
         self.character_id = le2byte(self.read(2))
         self.JPEGData = self.read[self.offset:]
 
+    def reference_offsets(self):
+        return []
+
 
 class DefineEditText(DefinitionTag):   # Tag type: 37
     def __init__(self, *args):
@@ -595,6 +833,16 @@ class DefineEditText(DefinitionTag):   # Tag type: 37
         # self.Bounds = RECT(...)
         # ...
 
+    def reference_offsets(self):
+        "HasFont の場合の FontID"
+        self.set_pos(self.content_offset + 2)
+        RECT().parse(self)      # Bounds
+        flags = ord(self.read(1))
+        self.read(1)
+        if flags & 0x01:   # HasFont
+            return [(self.pos, le2byte(self.read(2)))]
+        return []
+
 
 class DefineBitsJPEG3(DefinitionTag):    # Tag type: 35
     def __init__(self, *args):
@@ -606,6 +854,9 @@ class DefineBitsJPEG3(DefinitionTag):    # Tag type: 35
         self.AlphaDataOffset = le4byte(self.read(4))
         # ...
 
+    def reference_offsets(self):
+        return []
+
 
 class DefineBitsLossless(DefinitionTag):   # Tag type: 20
     def __init__(self, *args):
@@ -621,6 +872,9 @@ class DefineBitsLossless(DefinitionTag):   # Tag type: 20
             self.BitmapColorTableSize = ord(self.read(1))
         # self.ZlibBitmapData = ...
 
+    def reference_offsets(self):
+        return []
+
 
 class DoAction(SwfBlock):  # Tag type: 12
     def __init__(self, *args):
@@ -643,12 +897,13 @@ class StructBlock(object):
             self.before_parse_offset = self.block.pos
             self.read = block.read
             self.read_bits = block.read_bits
+            self.read_sbits = block.read_sbits
             self.align_byte = block.align_byte
             self.get_bits = block.get_bits
             
     def parse_end(self):
         self.block.align_byte()
-        self._value = self.block.value[self.before_parse_offset: self.block.pos]
+        self._value = self.block.buf[self.before_parse_offset: self.block.pos]
         self.length = self.block.pos - self.before_parse_offset
 
     def __getstate__(self):
@@ -681,7 +936,7 @@ class GRADERECORD(StructBlock):
         StructBlock.__init__(self, block)
 
         self.Ratio = ord(self.read(1))
-        if self.block.tag_name in ('DefineShape1', 'DefineShape2'):
+        if self.block.tag_name in ('DefineShape', 'DefineShape2'):
             self.Color = RGB(self.block)
         elif self.block.tag_name == "DefineShape3":
             self.Color = RGBA(self.block)
@@ -700,6 +955,12 @@ class GRADIENT(StructBlock):
             self.GradientRecords.append(GRADERECORD(self.block))
 
 
+class FOCALGRADIENT(GRADIENT):   # SWF 8 or later
+    def __init__(self, block):
+        GRADIENT.__init__(self, block)
+        self.FocalPoint = self.read(2)   # FIXED8
+
+
 class FILLSTYLE(StructBlock):
     def __init__(self, block):
         StructBlock.__init__(self, block)
@@ -715,13 +976,15 @@ class FILLSTYLE(StructBlock):
         if self.FillStyleType in ('\x10', '\x12', '\x13'):
             self.GradientMatrix = MATRIX()
             self.GradientMatrix.parse(self.block)
-        
+            self.block.align_byte()   # GRADIENT はバイト境界から始まる
+
         if self.FillStyleType in ('\x10', '\x12'):
             self.Gradient = GRADIENT(self.block)
-        # elif self.FillStyleTYPE == '\x13':  # SWF 8 or later
-        #     self.Gradient = FOCALGRADIENT(self.block)
+        elif self.FillStyleType == '\x13':  # SWF 8 or later
+            self.Gradient = FOCALGRADIENT(self.block)
 
         if self.FillStyleType in ('\x40', '\x41', '\x42', '\x43'):
+            self.bitmap_id_offset = self.block.pos
             self.BitmapId = le2byte(self.read(2))
             self.BitmapMatrix = MATRIX()
             self.BitmapMatrix.parse(self.block)
@@ -732,11 +995,12 @@ class FILLSTYLEARRAY(StructBlock):
         StructBlock.__init__(self, block)
 
         self.FillStyleCount = ord(self.read(1))
-        if self.FillStyleCount == '\xff':
-            self.FillStyleCountExtended = le2byte(self.read(2))
+        count = self.FillStyleCount
+        if self.FillStyleCount == 0xff:
+            self.FillStyleCountExtended = count = le2byte(self.read(2))
 
         self.FillStyles = []
-        for i in range(self.FillStyleCount):
+        for i in range(count):
             self.FillStyles.append(FILLSTYLE(self.block))
 
 
@@ -754,12 +1018,13 @@ class LINESTYLEARRAY(StructBlock):
     def __init__(self, block):
         StructBlock.__init__(self, block)
         self.LineStyleCount = ord(self.read(1))
-        if self.LineStyleCount == ord('\xff'):
-            self.LineStyleCountExtended = le2byte(self.read(2))
+        count = self.LineStyleCount
+        if self.LineStyleCount == 0xff:
+            self.LineStyleCountExtended = count = le2byte(self.read(2))
 
         self.LineStyles = []
         if self.block.tag_name in ('DefineShape', 'DefineShape2', 'DefineShape3'):
-            for i in range(self.LineStyleCount):
+            for i in range(count):
                 self.LineStyles.append(LINESTYLE(self.block))
         #elif self.block.tag_name == 'DefineShape4':
         #    self.LineStyles.append(LINESTYLE2(self.block))
@@ -774,105 +1039,126 @@ SHAPERECORDS には、４種類の ShapeRecord,
 が連なり、それぞれが byte_aligned されていない
 それをパースする
 """
-class EndShapeRecord(StructBlock):
-    def __init__(self, block):
-        StructBlock.__init__(self, block)
-        self.TypeFlag = self.read_bits(1)
-        self.EndOfShape = self.read_bits(5)
-
-class StyleChangeRecord(StructBlock):
-    def __init__(self, block, fill_bits, line_bits):
-        StructBlock.__init__(self, block)
-        self.TypeFlag = self.read_bits(1)
-        self.StateNewStyles = self.read_bits(1)   # New styles flag (only DefineShape2, 3) 
-        self.StateLineStyle = self.read_bits(1)
-        self.StateFillStyle1 = self.read_bits(1)
-        self.StateFillStyle0 = self.read_bits(1)
-        self.StateMoveTo = self.read_bits(1)
-        if b2i(self.StateMoveTo):
-            self.MoveBits = self.read_bits(5)
-            self.MoveDeltaX = SB(self.read_bits(b2i(self.MoveBits)))
-            self.MoveDeltaY = SB(self.read_bits(b2i(self.MoveBits)))
-        if b2i(self.StateFillStyle0):
-            self.FillStyle0 = self.read_bits(fill_bits)
-        if b2i(self.StateFillStyle1):
-            self.FillStyle1 = self.read_bits(fill_bits)
-        if b2i(self.StateLineStyle):
-            self.LineStyle = self.read_bits(line_bits)
-        if b2i(self.StateNewStyles) and False:
-            self.FillStyes = FILLSTYLEARRAY(self.block)
-            self.LineStyles = LINESTYLEARRAY(self.block)
-            self.NumFillBits = self.read_bits(4)
-            self.NumLineBits = self.read_bits(4)
-
-
-class StraightEdgeRecord(StructBlock):
-    def __init__(self, block):
-        StructBlock.__init__(self, block)
-        self.TypeFlag = self.read_bits(1)
-        self.StraightFlag = self.read_bits(1)
-        self.NumBits = self.read_bits(4)   # 2 less than the actual number
-        self.GeneralLineFlag = self.read_bits(1)
-
-        if b2i(self.GeneralLineFlag) == 0:
-            self.VertLineFlag = self.read_bits(1)
-
-        self.DeltaX = None
-        self.DeltaY = None
-
-        if b2i(self.GeneralLineFlag) == 1 or b2i(self.VertLineFlag) == 0:
-            self.DeltaX = SB(self.read_bits(b2i(self.NumBits) + 2))
-        if b2i(self.GeneralLineFlag) == 1 or b2i(self.VertLineFlag) == 1:
-            self.DeltaY = SB(self.read_bits(b2i(self.NumBits) + 2))
-
-class CurvedEdgeRecord(StructBlock):
-    def __init__(self, block):
-        StructBlock.__init__(self, block)
-        self.TypeFlag = self.read_bits(1)
-        self.StraightFlag = self.read_bits(1)
-        self.NumBits = self.read_bits(4)
-        self.ControlDeltaX = SB(self.read_bits(b2i(self.NumBits) + 2))
-        self.ControlDeltaY = SB(self.read_bits(b2i(self.NumBits) + 2))
-        self.AnchorDeltaX = SB(self.read_bits(b2i(self.NumBits) + 2))
-        self.AnchorDeltaY = SB(self.read_bits(b2i(self.NumBits) + 2))
+END_SHAPE_RECORD = 0
+STYLE_CHANGE_RECORD = 1
+STRAIGHT_EDGE_RECORD = 2
+CURVED_EDGE_RECORD = 3
 
 
 class SHAPERECORDS(StructBlock):
+    """
+    ShapeRecord を 1 つずつオブジェクトにせず、列ごとの array に格納する
+    i 番目の ShapeRecord は
+
+      kinds[i]          : *_RECORD
+      dx[i], dy[i]      : StraightEdge の Delta, CurvedEdge の AnchorDelta,
+                          StyleChange の MoveDelta (MoveTo の座標)
+      cx[i], cy[i]      : CurvedEdge の ControlDelta
+      fill0[i], fill1[i], line[i]
+                        : StyleChange の FillStyle0, FillStyle1, LineStyle
+                          (変更しない場合は -1)
+      flags[i]          : StyleChange の State* フラグ (下位 5 bit)
+
+    StateNewStyles で追加される (FILLSTYLEARRAY, LINESTYLEARRAY) は
+    new_styles[i] に入る
+    """
     def __init__(self, block, NumFillBits, NumLineBits):
         StructBlock.__init__(self, block)
-        self.blocks = []
         self.FillBits = NumFillBits
         self.LineBits = NumLineBits
+        self.kinds = array('B')
+        self.flags = array('B')
+        self.dx = array('l')
+        self.dy = array('l')
+        self.cx = array('l')
+        self.cy = array('l')
+        self.fill0 = array('l')
+        self.fill1 = array('l')
+        self.line = array('l')
+        self.new_styles = {}
 
         block.align_byte()
         self.block.shape_records_offset = self.block.pos
-        s = self.parse_shape_record()
-        while True:
-            self.blocks.append(s)
-            if isinstance(s, EndShapeRecord):
-                break
-            s = self.parse_shape_record()
+        self.parse_shape_records()
         self.parse_end()
 
         self.block.shape_records_length = self.length
 
-    def parse_shape_record(self):
-        shape_bits = self.get_bits(6)
-        type_flag = shape_bits[0]
-        if not type_flag:   # Non-edge record flag
-            if b2i(shape_bits[1:]) == 0:
-                return EndShapeRecord(self.block)
-            else:
-                return StyleChangeRecord(
-                    self.block,
-                    self.FillBits,
-                    self.LineBits
-                    )
-        else:   # Edge Record Flag
-            if not shape_bits[1]:
-                return CurvedEdgeRecord(self.block)
+    def parse_shape_records(self):
+        read_bits = self.read_bits
+        read_sbits = self.read_sbits
+        new_styles = self.block.tag_name != 'DefineShape'
+        fill_bits = self.FillBits
+        line_bits = self.LineBits
+        columns = (self.kinds, self.flags, self.dx, self.dy, self.cx, self.cy,
+                   self.fill0, self.fill1, self.line)
+        kinds, flags, dx, dy, cx, cy, fill0, fill1, line = [c.append for c in columns]
+
+        while True:
+            if read_bits(1):   # Edge Record Flag
+                n = read_bits(5)
+                if n & 0x10:   # StraightEdgeRecord
+                    n = (n & 0xf) + 2
+                    if read_bits(1):   # GeneralLineFlag
+                        x = read_sbits(n)
+                        y = read_sbits(n)
+                    elif read_bits(1):   # VertLineFlag
+                        x = 0
+                        y = read_sbits(n)
+                    else:
+                        x = read_sbits(n)
+                        y = 0
+                    kinds(STRAIGHT_EDGE_RECORD)
+                    cx(0)
+                    cy(0)
+                else:   # CurvedEdgeRecord
+                    n = n + 2
+                    kinds(CURVED_EDGE_RECORD)
+                    cx(read_sbits(n))
+                    cy(read_sbits(n))
+                    x = read_sbits(n)
+                    y = read_sbits(n)
+                flags(0)
+                dx(x)
+                dy(y)
+                fill0(-1)
+                fill1(-1)
+                line(-1)
+                continue
+
+            state = read_bits(5)
+            flags(state)
+            cx(0)
+            cy(0)
+            if state == 0:   # EndShapeRecord
+                kinds(END_SHAPE_RECORD)
+                dx(0)
+                dy(0)
+                fill0(-1)
+                fill1(-1)
+                line(-1)
+                break
+
+            kinds(STYLE_CHANGE_RECORD)
+            if state & 0x01:   # StateMoveTo
+                n = read_bits(5)
+                dx(read_sbits(n))
+                dy(read_sbits(n))
             else:
-                return StraightEdgeRecord(self.block)
+                dx(0)
+                dy(0)
+            fill0(read_bits(fill_bits) if state & 0x02 else -1)
+            fill1(read_bits(fill_bits) if state & 0x04 else -1)
+            line(read_bits(line_bits) if state & 0x08 else -1)
+            if state & 0x10 and new_styles:   # StateNewStyles (DefineShape2, 3)
+                self.new_styles[len(self.kinds) - 1] = (
+                    FILLSTYLEARRAY(self.block),
+                    LINESTYLEARRAY(self.block))
+                fill_bits = read_bits(4)
+                line_bits = read_bits(4)
+
+    def __len__(self):
+        return len(self.kinds)
 
     @property
     def value(self):
@@ -884,8 +1170,8 @@ class SHAPEWITHSTYLE(StructBlock):
         StructBlock.__init__(self, block)
         self.FillStyles = FILLSTYLEARRAY(self.block)
         self.LineStyles = LINESTYLEARRAY(self.block)
-        self.NumFillBits = b2i(self.read_bits(4))
-        self.NumLineBits = b2i(self.read_bits(4))
+        self.NumFillBits = self.read_bits(4)
+        self.NumLineBits = self.read_bits(4)
         self.ShapeRecords = SHAPERECORDS(self.block, self.NumFillBits, self.NumLineBits)
 
 
@@ -896,7 +1182,7 @@ DefineShape4 (only SWF 8 or later)
 class DefineShape(DefinitionTag):
     def __init__(self, *args):
         DefinitionTag.__init__(self, *args)
-        if self.swf and self.swf.flag['PARSE_SHAPE']:
+        if self.swf and (self.swf.flag['PARSE_SHAPE'] or self.swf.flag['PARSE']):
             self.parse()
 
     def parse(self):
@@ -906,36 +1192,149 @@ class DefineShape(DefinitionTag):
         self.ShapeBounds.parse(self)
         self.align_byte()
         self.Shapes = SHAPEWITHSTYLE(self)
+        self.align_byte()
+        self.shapes_end = self.pos
+        self.parsed_buf = self.buf
+
+    def parse_shapes(self):
+        "まだパースしていないか、パースした後に value が変わっていればパースし直す"
+        if getattr(self, 'parsed_buf', None) is not self.buf:
+            self.set_pos(self.content_offset)
+            self.parse()
+
+    def reference_offsets(self):
+        """
+        FILLSTYLE の BitmapId. 位置は今の buf から求める
+        タグの最後まで正しくパースできない場合は None
+        """
+        try:
+            self.parse_shapes()
+        except (StringError, BitsError):
+            return None
+        if self.shapes_end != len(self.buf):
+            return None
+        records = self.Shapes.ShapeRecords
+        fill_styles = [self.Shapes.FillStyles] + \
+            [records.new_styles[i][0] for i in sorted(records.new_styles)]
+        ret = []
+        for styles in fill_styles:
+            for style in styles.FillStyles:
+                # 0xffff はビットマップを参照しない
+                bitmap_id = getattr(style, 'BitmapId', 0xffff)
+                if bitmap_id != 0xffff:
+                    ret.append((style.bitmap_id_offset, bitmap_id))
+        return ret
+
+    def replace_references(self, mapping):
+        replaced = DefinitionTag.replace_references(self, mapping)
+        if replaced:
+            # パースした FILLSTYLE の BitmapId も更新する
+            self.parse_shapes()
+        return replaced
 
     def replace_rect(self, rect):
-        self.value = self.value[:self.rect_offset] + \
-            rect.value + \
-            self.value[(self.rect_offset + len(self.ShapeBounds.value)):]
-        self.ShapeBounds = rect
+        self.parse_shapes()
+        old_length = len(self.ShapeBounds.value)
+        new_value = rect.value
+        self.value = self.buf[:self.rect_offset] + \
+            new_value + \
+            self.buf[(self.rect_offset + old_length):]
+        self.set_length(len(self.buf) - self.content_offset)
+        # RECT の長さが変わると以降の位置がずれるので、Shapes もパースし直す
+        self.set_pos(self.content_offset)
+        self.parse()
 
+    def get_bounds(self):
+        """
+        ShapeRecords の座標を積算し、線幅を含めた
+        (x_min, x_max, y_min, y_max) を twips で返す
+        曲線は制御点から求めた曲線上の極値までを含める
+        """
+        self.parse_shapes()
+        records = self.Shapes.ShapeRecords
+        line_styles = self.Shapes.LineStyles.LineStyles
+        kinds, flags, line = records.kinds, records.flags, records.line
+        dx, dy, cx, cy = records.dx, records.dy, records.cx, records.cy
+
+        x = y = 0
+        half = 0   # 現在の線幅の半分
+        x_min = y_min = x_max = y_max = None
+        for i, kind in enumerate(kinds):
+            if kind == STYLE_CHANGE_RECORD:
+                if i in records.new_styles:
+                    line_styles = records.new_styles[i][1].LineStyles
+                    half = 0
+                if line[i] > 0:
+                    half = line_styles[line[i] - 1].width / 2.0
+                elif line[i] == 0:
+                    half = 0
+                if flags[i] & 0x01:   # MoveTo は絶対座標
+                    x = dx[i]
+                    y = dy[i]
+                continue
+            elif kind == STRAIGHT_EDGE_RECORD:
+                nx = x + dx[i]
+                ny = y + dy[i]
+                xs = (x, nx)
+                ys = (y, ny)
+            elif kind == CURVED_EDGE_RECORD:
+                qx = x + cx[i]
+                qy = y + cy[i]
+                nx = qx + dx[i]   # AnchorDelta は制御点からの差分
+                ny = qy + dy[i]
+                xs = (x, nx, _curve_extremum(x, qx, nx))
+                ys = (y, ny, _curve_extremum(y, qy, ny))
+            else:
+                break
+            lo = min(xs) - half
+            hi = max(xs) + half
+            if x_min is None or lo < x_min: x_min = lo
+            if x_max is None or hi > x_max: x_max = hi
+            lo = min(ys) - half
+            hi = max(ys) + half
+            if y_min is None or lo < y_min: y_min = lo
+            if y_max is None or hi > y_max: y_max = hi
+            x = nx
+            y = ny
+
+        if x_min is None:   # edge が無い
+            return (0, 0, 0, 0)
+        return tuple(int(round(v)) for v in (x_min, x_max, y_min, y_max))
+
+    def recompute_bounds(self):
+        """
+        get_bounds() で求めた ShapeBounds に書き換える
+        変更が無ければ value はそのまま
+        """
+        bounds = self.get_bounds()
+        attrs = ('x_min', 'x_max', 'y_min', 'y_max')
+        if bounds != tuple(self.ShapeBounds.getattr_value(a) for a in attrs):
+            rect = RECT()
+            for attr, v in zip(attrs, bounds):
+                rect.setattr_value(attr, v)
+            rect.generate_bits()
+            self.replace_rect(rect)
+        return self.ShapeBounds
 
-class DefineShape2(DefinitionTag):
-    def __init__(self, *args):
-        DefinitionTag.__init__(self, *args)
-        #self.parse()
 
-    def parse(self):
-        self.ShapeId = le2byte(self.read(2))    # Shape ID
-        self.ShapeBounds = RECT()
-        self.ShapeBounds.parse(self)
-        # self.Shapes = SHAPEWITHSTYLE(self)
+def _curve_extremum(p0, p1, p2):
+    "2 次ベジェ曲線 p0, p1 (制御点), p2 の極値. 無ければ p0"
+    d = p0 - 2 * p1 + p2
+    if d:
+        t = float(p0 - p1) / d
+        if 0 < t < 1:
+            return (1 - t) * (1 - t) * p0 + 2 * t * (1 - t) * p1 + t * t * p2
+    return p0
 
 
-class DefineShape3(DefinitionTag):
-    def __init__(self, *args):
-        DefinitionTag.__init__(self, *args)
-        #self.parse()
+class DefineShape2(DefineShape):
+    "DefineShape に加えて 255 以上の style と StateNewStyles を持つ"
+    pass
 
-    def parse(self):
-        self.ShapeId = le2byte(self.read(2))    # Shape ID
-        self.ShapeBounds = RECT()
-        self.ShapeBounds.parse(self)
-        # self.Shapes = SHAPEWITHSTYLE(self)
+
+class DefineShape3(DefineShape):
+    "DefineShape2 の色が RGBA になったもの"
+    pass
 
 
 class DefineMorphShape(DefinitionTag):
@@ -975,6 +1374,9 @@ class DefineFont2(DefinitionTag):
     def parse(self):
         self.character_id = le2byte(self.read(2))  # FontID
 
+    def reference_offsets(self):
+        return []
+
 
 class DefineFontName(DefinitionTag):
     def __init__(self, *args):
@@ -986,6 +1388,9 @@ class DefineFontName(DefinitionTag):
         self.FontName = self.read_string()
         self.FontCopyright = self.read_string()
 
+    def reference_offsets(self):
+        return []
+
 
 """
 PlaceObject は SWF3 以降滅多に用いられないようなので記述せず
@@ -1061,7 +1466,7 @@ class PlaceObject2(SwfBlock):
             self.tag,
             self.length,
             self.content_offset,
-            self.value,
+            self.buf,
             base_block,
             swf,
             False)    # IS_PARSE
@@ -1075,6 +1480,7 @@ class PlaceObject2(SwfBlock):
             'target_character_id_offset',
             'target_character_id',
             'matrix_offset',
+            'f_place_has_name',
             'name_offset',
             'name',
             ):
@@ -1086,14 +1492,15 @@ class PlaceObject2(SwfBlock):
         # See: http://www.m2osw.com/swf_tag_placeobject2
         # Flash Lite 1.1 (Flash Version 4) を想定したコード
 
-        self.f_place_reserved, \
-        self.f_place_has_clipping_depth, \
-        self.f_place_has_name, \
-        self.f_place_has_ratio, \
-        self.f_place_has_color_transform, \
-        self.f_place_has_matrix, \
-        self.f_place_has_character, \
-        self.f_place_has_move = self.read_bits(8)
+        flags = self.read_bits(8)
+        self.f_place_reserved = bool(flags & 0x80)
+        self.f_place_has_clipping_depth = bool(flags & 0x40)
+        self.f_place_has_name = bool(flags & 0x20)
+        self.f_place_has_ratio = bool(flags & 0x10)
+        self.f_place_has_color_transform = bool(flags & 0x08)
+        self.f_place_has_matrix = bool(flags & 0x04)
+        self.f_place_has_character = bool(flags & 0x02)
+        self.f_place_has_move = bool(flags & 0x01)
 
         self.depth_offset = self.pos
         self.depth = le2byte(self.read(2))
@@ -1127,38 +1534,48 @@ class PlaceObject2(SwfBlock):
     def replace_matrix(self, matrix):
         diff = len(matrix) - len(self.matrix)
         
-        self.value = self.value[:self.matrix_offset] + \
-            matrix.value + self.value[(self.matrix_offset + len(self.matrix)):]
+        self.value = self.buf[:self.matrix_offset] + \
+            matrix.value + self.buf[(self.matrix_offset + len(self.matrix)):]
         self.matrix = matrix
         
         # PlaceObject2 自体のヘッダーの長さを変更する
-        self.set_length(len(self.value) - self.content_offset)
+        self.set_length(len(self.buf) - self.content_offset)
         if self.base_block:
             self.base_block.update_value()
 
     def set_target_character_id(self, num):
         assert isinstance(num, int)
         assert hasattr(self, 'target_character_id_offset')
+        if self.swf:
+            self.swf.index_remove([self], self.base_block)
         self.value = \
-            self.value[:self.target_character_id_offset] + _h16(num) + \
-            self.value[(self.target_character_id_offset + 2):]
+            self.buf[:self.target_character_id_offset] + _h16(num) + \
+            self.buf[(self.target_character_id_offset + 2):]
         self.target_character_id = num
+        if self.swf:
+            self.swf.index_add([self], self.base_block)
 
     def set_depth(self, num):
         assert isinstance(num, int)
         self.value = \
-            self.value[:self.depth_offset] + _h16(num) + \
-            self.value[(self.depth_offset + 2):]
+            self.buf[:self.depth_offset] + _h16(num) + \
+            self.buf[(self.depth_offset + 2):]
         self.depth = num
         
     def set_name(self, name):
         if self.f_place_has_name:
+            if self.swf:
+                self.swf.index_remove([self], self.base_block)
             new_name = name + '\x00'
             self.value = \
-                self.value[:self.name_offset] + new_name + \
-                self.value[(self.name_offset + len(self.name) + 1):]
+                self.buf[:self.name_offset] + new_name + \
+                self.buf[(self.name_offset + len(self.name) + 1):]
             self.name = name
-            self.set_length(len(self.value) - self.content_offset)
+            self.set_length(len(self.buf) - self.content_offset)
+            if self.swf:
+                self.swf.index_add([self], self.base_block)
+            if self.base_block:
+                self.base_block.update_value()
         else:
             pass
 
@@ -61,31 +61,10 @@ class SwfDepthChecker(object):
                         self.layer_depth[name] = depth
 
     def check_movie_clip_layer_depth(self):
+        graph = self.swf.dependency_graph
         for b in self.swf.blocks:
             if isinstance(b, DefineSprite):
-                self.check_define_sprite_blocks(b)
-
-    def check_define_sprite_blocks(self, define_sprite):
-        if define_sprite.character_id not in self.layer_depth:
-            self.layer_depth[define_sprite.character_id] = 1
-
-        layer_depth = self.layer_depth[define_sprite.character_id]
-
-        for b in define_sprite.blocks:
-            if isinstance(b, PlaceObject2):
-                if b.target_character_id in self.swf.character_dict:
-                    c = self.swf.character_dict[b.target_character_id]
-                    if isinstance(c, DefineSprite):
-                        before_depth = layer_depth
-
-                        if c.character_id not in self.layer_depth :
-                            self.layer_depth[c.character_id] = 1
-                        layer_depth = max(layer_depth, self.layer_depth[c.character_id] + 1)
-
-                        if layer_depth > before_depth:
-                            self.layer_depth[define_sprite.character_id] = layer_depth
-
-        return layer_depth
+                self.layer_depth[b.character_id] = graph.height(b.character_id)
 
 
 if __name__ == '__main__':
@@ -93,6 +72,6 @@ if __name__ == '__main__':
         print "usage: python swf_checker.py [input.swf] [limit_depth]"
     else:
         c = SwfDepthChecker(
-            swf = Swf(open(sys.argv[1]).read()),
+            swf = Swf.open(sys.argv[1]),
             limit_depth = int(sys.argv[2]))
 
@@ -0,0 +1,614 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tomato.swf_index  - indexes of SwfBlock(s) in Swf
+
+--
+
+MIT License
+
+Copyright (C) 2011 by Takahiro Kamatani
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from tomato import structure
+from tomato.structure import PlaceObject2, DefineSprite, DefinitionTag
+from tomato.parser import LazyBlocks, TAG_CODES, DEFINITION_TAGS, get_tag_codes
+from tomato.exceptions_tomato import CircularReference
+
+
+class BlockIndex(object):
+    """
+    Swf 内のブロックを (block, 親の DefineSprite) の組で索引する基底クラス
+    Swf.get_index() で最初に参照された時に全体を辿って作り、
+    以降は Swf のブロックを変更する関数から add_blocks, remove_blocks で更新する
+    親が None のブロックは Swf.blocks 直下にある
+    """
+    # 索引するタグ名. LazyBlocks の場合はこのタグと DefineSprite だけをパースする
+    # None の場合は全てのタグ
+    TAGS = None
+
+    def __init__(self, swf):
+        self.swf = swf
+        self.tag_codes = None
+        if self.TAGS is not None:
+            self.tag_codes = get_tag_codes(self.TAGS + ('DefineSprite', ))
+        self.clear()
+        self.add_blocks(swf.blocks)
+
+    def clear(self):
+        pass
+
+    def iter_blocks(self, blocks):
+        if isinstance(blocks, LazyBlocks) and self.tag_codes is not None:
+            return blocks.filter_tags(self.tag_codes)
+        return blocks
+
+    def add_blocks(self, blocks, parent=None):
+        "blocks と DefineSprite 内のブロックを索引に加える"
+        for block in self.iter_blocks(blocks):
+            self.add(block, parent)
+            if isinstance(block, DefineSprite):
+                self.add_blocks(block.blocks, block)
+
+    def remove_blocks(self, blocks, parent=None):
+        "blocks と DefineSprite 内のブロックを索引から除く. 索引に無いブロックは無視する"
+        for block in self.iter_blocks(blocks):
+            self.remove(block, parent)
+            if isinstance(block, DefineSprite):
+                self.remove_blocks(block.blocks, block)
+
+    def add(self, block, parent):
+        pass
+
+    def remove(self, block, parent):
+        pass
+
+    def update(self, block):
+        "block の内容 (value) が変わった時に呼ばれる"
+        pass
+
+
+def parent_key(parent):
+    return None if parent is None else id(parent)
+
+
+def is_glob(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+def sort_entries(swf, entries):
+    """
+    (block, 親の DefineSprite) の list を Swf 内の順番に並べ替えて返す
+    DefineSprite 内のブロックは、その DefineSprite の位置に並ぶ
+    """
+    tag_codes = set(block.tag for block, parent in entries)
+    tag_codes.add(TAG_CODES['DefineSprite'])
+
+    def positions(blocks):
+        if isinstance(blocks, LazyBlocks):
+            blocks = blocks.filter_tags(tag_codes)
+        return dict((id(block), i) for i, block in enumerate(blocks))
+
+    root = positions(swf.blocks)
+    children = {}
+
+    def key(entry):
+        block, parent = entry
+        if parent is None:
+            return root.get(id(block), len(root)), -1
+        if id(parent) not in children:
+            children[id(parent)] = positions(parent.blocks)
+        return root.get(id(parent), len(root)), children[id(parent)].get(id(block), -1)
+
+    return sorted(entries, key=key)
+
+
+def add_entry(d, key, block, parent):
+    "d[key] の list に (block, parent) を加える. 既にあれば加えない. 加えたら True"
+    entries = d.setdefault(key, [])
+    for e in entries:
+        if e[0] is block:
+            return False
+    entries.append((block, parent))
+    return True
+
+
+def remove_entry(d, key, block):
+    "d[key] の list から block の組を除く"
+    entries = d.get(key)
+    if entries:
+        entries[:] = [e for e in entries if e[0] is not block]
+        if not entries:
+            del d[key]
+
+
+class NameIndex(BlockIndex):
+    """
+    MovieClip の名前 (PlaceObject2.name) -> [(PlaceObject2, 親の DefineSprite), ...]
+    同じ名前の PlaceObject2 は Swf 内の順番に並ぶ
+    """
+    TAGS = ('PlaceObject2', )
+
+    def __init__(self, swf):
+        self.building = True
+        BlockIndex.__init__(self, swf)
+        self.building = False
+
+    def clear(self):
+        self.names = OrderedDict()
+        # 親の id(DefineSprite) (Swf.blocks 直下は None) -> [(PlaceObject2, 親), ...]
+        self.children = {}
+        # 後から加えたために並べ替えが必要な names, children のキー
+        self.unsorted_names = set()
+        self.unsorted_children = set()
+
+    def add(self, block, parent):
+        if isinstance(block, PlaceObject2) and hasattr(block, 'name'):
+            if add_entry(self.names, block.name, block, parent) and not self.building:
+                self.unsorted_names.add(block.name)
+            key = parent_key(parent)
+            if add_entry(self.children, key, block, parent) and not self.building:
+                self.unsorted_children.add(key)
+
+    def get_entries(self, d, unsorted, key):
+        "d[key] の list. 後から加えたものがあれば Swf 内の順番に並べ替えてから返す"
+        entries = d.get(key, [])
+        if key in unsorted:
+            unsorted.discard(key)
+            if len(entries) > 1:
+                entries[:] = sort_entries(self.swf, entries)
+        return entries
+
+    def remove(self, block, parent):
+        if isinstance(block, PlaceObject2) and hasattr(block, 'name'):
+            remove_entry(self.names, block.name, block)
+            remove_entry(self.children, parent_key(parent), block)
+
+    def get(self, name, parent=False):
+        """
+        name の (PlaceObject2, 親の DefineSprite) を返す. 無ければ (None, None)
+        parent を指定した場合はその DefineSprite 直下のものだけを探す
+        """
+        for entry in self.get_entries(self.names, self.unsorted_names, name):
+            if parent is False or entry[1] is parent:
+                return entry
+        return None, None
+
+    def match(self, pattern, parent):
+        """
+        parent (DefineSprite か None) 直下にある、名前が pattern に合う PlaceObject2 の list
+        pattern には fnmatch の *, ?, [] が使える
+        """
+        if not is_glob(pattern):
+            return [po2 for po2, p in self.get_entries(self.names, self.unsorted_names, pattern)
+                    if p is parent]
+        entries = self.get_entries(self.children, self.unsorted_children, parent_key(parent))
+        return [po2 for po2, p in entries if fnmatchcase(po2.name, pattern)]
+
+    def iter_names(self):
+        "名前を PlaceObject2 の数だけ Swf 内の順番に返す"
+        entries = []
+        for name_entries in self.names.itervalues():
+            entries.extend(name_entries)
+        for po2, parent in sort_entries(self.swf, entries):
+            yield po2.name
+
+
+class ReferenceIndex(BlockIndex):
+    """
+    character_id -> [(その character_id を配置する PlaceObject2, 親の DefineSprite), ...]
+    PlaceObject2.set_target_character_id でも更新される
+    """
+    TAGS = ('PlaceObject2', )
+
+    def clear(self):
+        self.refs = {}
+
+    def add(self, block, parent):
+        if isinstance(block, PlaceObject2) and block.target_character_id is not None:
+            add_entry(self.refs, block.target_character_id, block, parent)
+
+    def remove(self, block, parent):
+        if isinstance(block, PlaceObject2) and block.target_character_id is not None:
+            remove_entry(self.refs, block.target_character_id, block)
+
+    def get(self, character_id):
+        "character_id を配置している (PlaceObject2, 親の DefineSprite) の list"
+        return self.refs.get(character_id, [])
+
+    def is_referenced(self, character_id):
+        return character_id in self.refs
+
+
+class TagIndex(BlockIndex):
+    """
+    タグ名 (クラス名) -> {id(block): (block, 親の DefineSprite)}
+    全てのタグを一度にパースしないように、タグ名ごとに最初に参照された時に作る
+    同じタグ名のブロックは Swf 内の順番に並ぶ
+    """
+    def __init__(self, swf):
+        self.swf = swf
+        self.tags = {}
+        self.tag_codes = None   # 索引を作ったタグ (None は全て)
+        self.unsorted = set()   # 後からブロックを加えたタグ名
+
+    def get(self, tag_name):
+        entries = self.tags.get(tag_name)
+        if entries is None:
+            entries = self.build(tag_name)
+        elif tag_name in self.unsorted:
+            # 加えたブロックは最後に入っているので、参照された時に並べ替える
+            self.unsorted.discard(tag_name)
+            entries = self.tags[tag_name] = OrderedDict(
+                (id(entry[0]), entry) for entry in sort_entries(self.swf, entries.values()))
+        return entries
+
+    def build(self, tag_name):
+        self.tags[tag_name] = OrderedDict()
+        names = self.tags.keys()
+        if all(name in TAG_CODES for name in names):
+            self.tag_codes = get_tag_codes(names + ['DefineSprite'])
+        else:
+            self.tag_codes = None
+        self.add_blocks(self.swf.blocks, only=tag_name)
+        return self.tags[tag_name]
+
+    def add_blocks(self, blocks, parent=None, only=None):
+        tag_codes = self.tag_codes
+        if only in TAG_CODES:
+            tag_codes = get_tag_codes((only, 'DefineSprite'))
+        if isinstance(blocks, LazyBlocks) and tag_codes is not None:
+            blocks = blocks.filter_tags(tag_codes)
+        for block in blocks:
+            name = block.__class__.__name__
+            if name in self.tags and (only is None or name == only):
+                self.tags[name][id(block)] = (block, parent)
+                if only is None:
+                    self.unsorted.add(name)
+            if isinstance(block, DefineSprite):
+                self.add_blocks(block.blocks, block, only)
+
+    def remove(self, block, parent):
+        entries = self.tags.get(block.__class__.__name__)
+        if entries:
+            entries.pop(id(block), None)
+
+
+class HashIndex(BlockIndex):
+    """
+    DefinitionTag.hash -> {id(block): block}
+    Swf.blocks 直下の DefinitionTag (DefineSprite 以外) だけを索引する
+    ハッシュは get() で最初に必要になった時に計算する
+    """
+    def __init__(self, swf):
+        self.swf = swf
+        self.tag_codes = DEFINITION_TAGS - get_tag_codes(('DefineSprite', ))
+        self.clear()
+        self.add_blocks(swf.blocks)
+
+    def clear(self):
+        self.hashes = {}
+        self.keys = {}                  # id(block) -> hash
+        self.pending = OrderedDict()    # ハッシュを未計算のブロック
+        self.function = structure.hash_function
+
+    def add_blocks(self, blocks, parent=None):
+        # DefinitionTag は Swf.blocks 直下にしか無いので DefineSprite は辿らない
+        if parent is None:
+            for block in self.iter_blocks(blocks):
+                self.add(block, parent)
+
+    def remove_blocks(self, blocks, parent=None):
+        if parent is None:
+            for block in self.iter_blocks(blocks):
+                self.remove(block, parent)
+
+    def add(self, block, parent):
+        if (parent is None and isinstance(block, DefinitionTag)
+            and not isinstance(block, DefineSprite)):
+            self.pending[id(block)] = block
+
+    def remove(self, block, parent):
+        key = id(block)
+        self.pending.pop(key, None)
+        digest = self.keys.pop(key, None)
+        if digest is not None:
+            entries = self.hashes[digest]
+            del entries[key]
+            if not entries:
+                del self.hashes[digest]
+
+    def update(self, block):
+        # 索引にあるブロックなら、ハッシュを計算し直すために未計算に戻す
+        key = id(block)
+        if key in self.keys:
+            self.remove(block, None)
+            self.pending[key] = block
+
+    def get(self, digest):
+        "ハッシュが digest の DefinitionTag の list"
+        if self.function is not structure.hash_function:
+            # set_hash_function でハッシュ関数が変わったので全て計算し直す
+            blocks = [b for entries in self.hashes.values() for b in entries.values()]
+            pending = self.pending
+            self.clear()
+            for block in blocks + pending.values():
+                self.pending[id(block)] = block
+        for key, block in self.pending.iteritems():
+            self.keys[key] = block.hash
+            self.hashes.setdefault(block.hash, OrderedDict())[key] = block
+        self.pending.clear()
+        return self.hashes.get(digest, {}).values()
+
+
+class DependencyGraph(BlockIndex):
+    """
+    DefineSprite -> そのDefineSprite 内の PlaceObject2 が配置する character_id
+    DefineSprite は id(block) で持つので、character_id が変わっても辿れる
+    layers, closure, height の結果は索引が変わるまでキャッシュする
+    """
+    TAGS = ('PlaceObject2', )
+
+    def clear(self):
+        self.deps = {}      # id(DefineSprite) -> OrderedDict(character_id -> 配置数)
+        self.cache = {}
+
+    def add(self, block, parent):
+        if isinstance(block, DefineSprite):
+            self.deps.setdefault(id(block), OrderedDict())
+        elif (isinstance(block, PlaceObject2) and parent is not None
+              and block.target_character_id is not None):
+            entries = self.deps.setdefault(id(parent), OrderedDict())
+            ch_id = block.target_character_id
+            entries[ch_id] = entries.get(ch_id, 0) + 1
+        else:
+            return
+        self.cache.clear()
+
+    def remove(self, block, parent):
+        if isinstance(block, DefineSprite):
+            self.deps.pop(id(block), None)
+        elif (isinstance(block, PlaceObject2) and parent is not None
+              and block.target_character_id is not None):
+            entries = self.deps.get(id(parent))
+            ch_id = block.target_character_id
+            if entries and ch_id in entries:
+                entries[ch_id] -= 1
+                if not entries[ch_id]:
+                    del entries[ch_id]
+        else:
+            return
+        self.cache.clear()
+
+    def update(self, block):
+        # DefineSprite の character_id が変わると character_dict との対応も変わる
+        if id(block) in self.deps:
+            self.cache.clear()
+
+    def get(self, character_id):
+        "character_id の DefineSprite が直接配置している character_id の list"
+        return self.get_block_deps(self.swf.character_dict.get(character_id))
+
+    def get_block_deps(self, block):
+        if not isinstance(block, DefineSprite):
+            return []
+        entries = self.deps.get(id(block))
+        if entries is not None:
+            return entries.keys()
+        # 索引に無い DefineSprite はその場で調べる
+        ret = []
+        for b in block.blocks:
+            if isinstance(b, PlaceObject2) and b.target_character_id is not None \
+                    and b.target_character_id not in ret:
+                ret.append(b.target_character_id)
+        return ret
+
+    def layers(self, root):
+        """
+        root (character_id か DefineSprite) から辿れる character_id を
+        最初に現れた深さ毎に返す. {1: [直接配置しているもの], 2: [...], ...}
+        """
+        key = ('layers', root) if isinstance(root, (int, long)) else None
+        if key in self.cache:
+            return self.cache[key]
+        if key is None:
+            queue = self.get_block_deps(root)
+        else:
+            queue = self.get(root)
+        ret = {}
+        seen = set()
+        depth = 1
+        while queue:
+            layer = []
+            for ch_id in queue:
+                if ch_id not in seen:
+                    seen.add(ch_id)
+                    layer.append(ch_id)
+            if not layer:
+                break
+            ret[depth] = layer
+            queue = [d for ch_id in layer for d in self.get(ch_id)]
+            depth += 1
+        if key is not None:
+            self.cache[key] = ret
+        return ret
+
+    def closure(self, root):
+        "root から (間接的に) 配置されている character_id の set"
+        key = ('closure', root) if isinstance(root, (int, long)) else None
+        if key in self.cache:
+            return self.cache[key]
+        ret = set()
+        for layer in self.layers(root).values():
+            ret.update(layer)
+        if key is not None:
+            self.cache[key] = ret
+        return ret
+
+    def height(self, character_id, visiting=None):
+        """
+        DefineSprite の入れ子の深さ. DefineSprite 以外は 0
+        DefineSprite が自身を配置している場合は CircularReference
+        """
+        key = ('height', character_id)
+        if key in self.cache:
+            return self.cache[key]
+        if not isinstance(self.swf.character_dict.get(character_id), DefineSprite):
+            return 0
+        if visiting is None:
+            visiting = set()
+        if character_id in visiting:
+            raise CircularReference(
+                "DefineSprite (ID: %d) places itself" % character_id)
+        visiting.add(character_id)
+        ret = 1 + max([self.height(ch_id, visiting)
+                       for ch_id in self.get(character_id)] or [0])
+        visiting.remove(character_id)
+        self.cache[key] = ret
+        return ret
+
+
+# DefineSprite 内にあると、PlaceObject2 以外で character_id を参照するタグ
+# (PlaceObject, RemoveObject, StartSound, VideoFrame, PlaceObject3)
+UNRESOLVED_TAGS = frozenset([4, 5, 15, 61, 70])
+
+
+class SpriteHashIndex(BlockIndex):
+    """
+    DefineSprite の構造的なハッシュ -> {id(DefineSprite): DefineSprite}
+    構造的なハッシュは内部のタグから、PlaceObject2 の character_id を配置先の
+    構造的なハッシュに置き換えて計算するので、character_id が違っても同じになる
+    計算したハッシュはキャッシュし、変更されたブロックを (間接的に) 配置している
+    DefineSprite のものだけを計算し直す
+    """
+    TAGS = ('DefineSprite', )
+
+    def __init__(self, swf):
+        # 変更を通知している途中で作られないように、先に作っておく
+        swf.get_index(ReferenceIndex)
+        BlockIndex.__init__(self, swf)
+
+    def clear(self):
+        self.sprites = {}               # Swf.blocks 直下の DefineSprite
+        self.digests = {}               # id(DefineSprite) -> 構造的なハッシュ (None は比べられない)
+        self.hashes = {}
+        self.pending = OrderedDict()    # ハッシュを未計算の DefineSprite
+
+    def add(self, block, parent):
+        if parent is None and isinstance(block, DefineSprite):
+            self.sprites[id(block)] = block
+            self.pending[id(block)] = block
+        self.invalidate(block, parent)
+
+    def remove(self, block, parent):
+        self.invalidate(block, parent)
+        if parent is None and isinstance(block, DefineSprite):
+            self.sprites.pop(id(block), None)
+            self.pending.pop(id(block), None)
+            self.discard(block)
+
+    def update(self, block):
+        self.invalidate(block, block.base_block)
+
+    def discard(self, ds):
+        "ds のハッシュをキャッシュから除く. キャッシュに無ければ False"
+        key = id(ds)
+        if key not in self.digests:
+            return False
+        digest = self.digests.pop(key)
+        entries = self.hashes.get(digest)
+        if entries and key in entries:
+            del entries[key]
+            if not entries:
+                del self.hashes[digest]
+        if key in self.sprites:
+            self.pending[key] = ds
+        return True
+
+    def invalidate(self, block, parent):
+        "block の変更で構造的なハッシュが変わる DefineSprite をキャッシュから除く"
+        if not self.digests:
+            return
+        stack = [block if parent is None else parent]
+        while stack:
+            b = stack.pop()
+            if isinstance(b, DefineSprite):
+                # キャッシュに無ければ、それを配置している DefineSprite にも無い
+                if not self.discard(b):
+                    continue
+            elif not isinstance(b, DefinitionTag):
+                continue
+            for po2, p in self.swf.reference_index.get(b.character_id):
+                if p is not None:
+                    stack.append(p)
+
+    def structural_hash(self, dt, visiting=None):
+        """
+        DefinitionTag の構造的なハッシュ. DefineSprite 以外は DefinitionTag.hash
+        配置先が無い、循環している、PlaceObject2 以外で character_id を参照している
+        DefineSprite は比べられないので None
+        """
+        if not isinstance(dt, DefineSprite):
+            return None if dt is None else dt.hash
+        key = id(dt)
+        if key in self.digests:
+            return self.digests[key]
+        if visiting is None:
+            visiting = set()
+        if key in visiting:
+            return None
+        visiting.add(key)
+        digest = self.generate_hash(dt, visiting)
+        visiting.remove(key)
+
+        self.digests[key] = digest
+        if key in self.sprites:
+            self.pending.pop(key, None)
+            if digest is not None:
+                self.hashes.setdefault(digest, OrderedDict())[key] = dt
+        return digest
+
+    def generate_hash(self, ds, visiting):
+        # framecount と内部のタグ
+        values = [str(ds.buf[(ds.content_offset + 2):ds.blocks_offset])]
+        for b in ds.blocks:
+            if b.tag in UNRESOLVED_TAGS:
+                return None
+            if isinstance(b, PlaceObject2) and b.target_character_id is not None:
+                target = self.swf.character_dict.get(b.target_character_id)
+                digest = self.structural_hash(target, visiting)
+                if digest is None:
+                    return None
+                offset = b.target_character_id_offset
+                values.append(str(b.buf[:offset]))
+                values.append(str(digest))
+                values.append(str(b.buf[(offset + 2):]))
+            else:
+                values.append(str(b.value))
+        return structure.hash_function(''.join(values))
+
+    def get(self, digest):
+        "構造的なハッシュが digest の DefineSprite の list"
+        for ds in self.pending.values():
+            self.structural_hash(ds)
+        self.pending.clear()
+        return self.hashes.get(digest, {}).values()
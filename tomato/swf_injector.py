@@ -51,6 +51,11 @@ def _maketag(d, encode_option):
     tag += '\x00'
     return tag
 
+def _head_len(decomp_swf):
+    "File Header と最初のタグ (SetBackgroundColor) までの長さ"
+    rectbit = ord(decomp_swf[8]) >> 3
+    return int(((( 8 - ((rectbit*4+5)&7) )&7)+ rectbit*4 + 5 )/8) + 12 + 5;
+
 def create_swf(base_swf, params):
     "パラメーターを埋め込んだ Flash lite 1.1/2.0 ファイルを生成"
     # 圧縮されている場合は展開する
@@ -58,8 +63,7 @@ def create_swf(base_swf, params):
     
     # パラメーターを埋め込む
     tag = _maketag(params, get_encode(decomp_swf))
-    rectbit = ord(decomp_swf[8]) >> 3
-    head_len = int(((( 8 - ((rectbit*4+5)&7) )&7)+ rectbit*4 + 5 )/8) + 12 + 5;
+    head_len = _head_len(decomp_swf)
     head = decomp_swf[:head_len]
     tail = decomp_swf[head_len:]
     newhead = head[:4] + _h32(len(decomp_swf) + len(tag)) + head[8:]
@@ -104,6 +108,67 @@ def decompress(base_swf):
     return header + new_tail
 
 
+def adler32_combine(adler1, adler2, len2):
+    """
+    adler32(a) と adler32(b), len(b) から adler32(a + b) を求める
+    (zlib の adler32_combine と同じ)
+    """
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1 + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+    return (sum2 << 16) | sum1
+
+
+class PrecompressedSwf(object):
+    """
+    同じテンプレートに対して何度も create_swf を行うためのクラス
+    パラメーターを挿入する位置より後ろ (tail) は変わらないので、
+    一度だけ raw deflate で圧縮しておく
+    create_swf の際には head とパラメーターのタグだけを圧縮して full flush で区切り、
+    圧縮済みの tail を連結して Adler-32 を adler32_combine で求める
+
+    ex. template = PrecompressedSwf(open('base.swf').read())
+        template.create_swf({'a': 'hoge'})
+    """
+    def __init__(self, base_swf, level=zlib.Z_DEFAULT_COMPRESSION):
+        decomp_swf = decompress(base_swf)
+        head_len = _head_len(decomp_swf)
+        self.compressed = base_swf[:3] == 'CWS'
+        self.level = level
+        self.encode = get_encode(decomp_swf)
+        self.head = decomp_swf[:head_len]
+        self.tail = decomp_swf[head_len:]
+        self.file_length = len(decomp_swf)
+        if self.compressed:
+            self.tail_adler32 = zlib.adler32(self.tail) & 0xffffffff
+            c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.compressed_tail = c.compress(self.tail) + c.flush()
+            self.tail = None   # 展開した tail は不要
+
+    def create_swf(self, params):
+        "create_swf(base_swf, params) と同じ内容の SWF を返す"
+        tag = _maketag(params, self.encode)
+        head = self.head[:4] + _h32(self.file_length + len(tag)) + self.head[8:]
+        if not self.compressed:
+            return head + tag + self.tail
+
+        body = head[8:] + tag
+        c = zlib.compressobj(self.level)
+        adler = adler32_combine(
+            zlib.adler32(body) & 0xffffffff,
+            self.tail_adler32,
+            self.file_length - len(self.head))
+        return ''.join([
+            head[:8],
+            c.compress(body),
+            c.flush(zlib.Z_FULL_FLUSH),
+            self.compressed_tail,
+            struct.pack('>I', adler),
+            ])
+
+
 if __name__ == '__main__':
     params = {
         'a': 'hoge',
@@ -33,7 +33,7 @@ from tomato.swf_checker import SwfDepthChecker
 
 def mc2swf(in_swf_filename, out_dir, limit_depth):
     print "parsing %s ..." % in_swf_filename
-    in_swf = Swf(open(in_swf_filename).read())
+    in_swf = Swf.open(in_swf_filename)
     mc_base_bin = open('sample/mc/blank.swf').read()
 
     for mc_name in in_swf.get_movie_clip_name():
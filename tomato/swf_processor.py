@@ -31,48 +31,130 @@ THE SOFTWARE.
 import os
 import sys
 import time
+import mmap
+import zlib
+import itertools
 import msgpack
+from contextlib import contextmanager
+from cStringIO import StringIO
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from tomato.utils import _h32, _h16, le2byte, le4byte, get_fixed_point_number, \
-     Bits, s2b, b2i, flatten_defaultdict_set, \
+     Bits, flatten_defaultdict_set, view, \
      RECT, MATRIX, SERIALIZER_MOVIECLIP_V1 as MOVIECLIP_V1
-from tomato.parser import SwfBlockParser, deserialize_blocks
-from tomato.structure import StreamIO, DefinitionTag, PlaceObject2, DefineSprite, MovieClip
-from tomato.exceptions_tomato import MovieClipDoesNotExist, is_valid_swf
-from tomato.swf_injector import create_swf
+from tomato.parser import SwfBlockParser, LazyBlocks, LazyCharacterDict, \
+     TAG_CODES, get_tag_codes, deserialize_blocks, copy_blocks, iter_block_values, iter_block_buffers, iter_block_lengths, \
+     decompress_swf, iter_compress, SWF_TAG, DEFINITION_TAGS, make_swfblock, get_block_head
+from tomato.structure import StreamIO, DefinitionTag, PlaceObject2, DefineSprite, MovieClip, \
+     replace_uint16s, read_placed_id, replace_placed_id
+from tomato.swf_index import DependencyGraph, HashIndex, NameIndex, ReferenceIndex, \
+     SpriteHashIndex, TagIndex
+from tomato.exceptions_tomato import MovieClipDoesNotExist, CharacterIdExhausted, \
+     is_valid_swf
+from tomato.swf_injector import get_encode, _maketag
 
 
 DEBUG = False
 
+# character_id は UI16
+MAX_CHARACTER_ID = 0xffff
+
+# collect_garbage で character_id を参照しないとみなすタグ
+# (End, ShowFrame, RemoveObject, JPEGTables, SetBackgroundColor, DoAction,
+#  SoundStreamHead, SoundStreamBlock, Protect, RemoveObject2, FrameLabel,
+#  SoundStreamHead2, EnableDebugger, EnableDebugger2, ScriptLimits, SetTabIndex,
+#  FileAttributes, Metadata, DefineSceneAndFrameLabelData)
+CONTROL_TAGS = frozenset(
+    [0, 1, 5, 8, 9, 12, 18, 19, 24, 28, 43, 45, 58, 64, 65, 66, 69, 77, 86])
+
+# 先頭の character_id のキャラクターが残る場合だけ残すタグ
+# (DefineFontInfo, DefineButtonSound, DefineButtonCxform, DoInitAction,
+#  DefineFontInfo2, DefineFontAlignZones, CSMTextSettings, DefineScalingGrid)
+ATTACHED_TAGS = frozenset([13, 17, 23, 59, 62, 73, 74, 78])
+
 
 class Swf(StreamIO):
-    def __init__(self, value=None, PARSE_SHAPE=False):
+    def __init__(self, value=None, PARSE_SHAPE=False, LAZY=False, parse=None):
+        """
+        parse: パースするタグ (タグ番号, クラス, クラス名) の並び
+               指定しなかったタグはパースせず SwfBlock (DefinitionTag) のままにする
+               DefineSprite 内のタグをパースする場合は DefineSprite も含めること
+               ex. Swf(value, parse=(PlaceObject2, DefineSprite))
+        value が CWS (圧縮) の場合は展開してからパースする
+        """
         if value:
             is_valid_swf(value)
+            if value[:3] == 'CWS':
+                value = decompress_swf(value)
             StreamIO.__init__(self, value)
 
             # Swf をパースする際の設定
             self.flag = {}
             self.flag['PARSE_SHAPE'] = PARSE_SHAPE   # DefineShape 関連をパースする
+            self.flag['LAZY'] = LAZY   # タグは参照された時にパースする
+            self.flag['PARSE'] = None if parse is None else get_tag_codes(parse)
 
             # Parse Value
             self.parse_swfhead()
-            self.blocks = SwfBlockParser(self.swf_tail, swf=self).blocks
+            if LAZY:
+                self.blocks = LazyBlocks(self.swf_tail, swf=self)
+            else:
+                self.blocks = SwfBlockParser(self.swf_tail, swf=self).blocks
             self.character_dict = self.get_character_dict()
         else:
             # デシリアライズの際に用いる
             StreamIO.__init__(self)
         self.inject_params_dict = {}
+        self.indexes = {}   # BlockIndex のクラス -> 索引
+        self.allocator = None   # 最初に character_id を振る時に作る
+        self.dirty = None   # batch の中で更新を待っている DefineSprite
+        self.mmap = None    # Swf.open で開いた場合の mmap
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        """
+        SWF ファイルを mmap で読み込む
+        各タグは書き換えられるまで mmap の領域を参照し続けるので、
+        同じテンプレートを開く複数のプロセスでページキャッシュを共有できる
+        使い終わったら close() を呼ぶか、with Swf.open(path) as swf: として用いる
+        """
+        f = open(path, 'rb')
+        try:
+            value = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            swf = cls(value, **kwargs)
+        except:
+            value.close()
+            raise
+        swf.mmap = value
+        return swf
+
+    def close(self):
+        """
+        Swf.open で開いた mmap を閉じる
+        閉じた後は、この Swf (と copy() したもの) の書き換えていないタグを参照できない
+        """
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def serialize(self, f=None):
         "シリアライズを行う"
+        self.flush()
         ret = {
             'serializer_version': MOVIECLIP_V1,
             'rect': self.rect.serialize(),
             'swf_head': self.swf_head,
-            'swf_tail': self.swf_tail,
+            'swf_tail': str(self.swf_tail),
             'blocks': [],
             }
         for block in self.blocks:
@@ -97,29 +179,89 @@ class Swf(StreamIO):
         self.rect = RECT().deserialize(ret['rect'])
         self.swf_head = ret['swf_head']
         self.swf_tail = ret['swf_tail']
-        self.flag = {'PARSE_SHAPE': False}
+        self.flag = {'PARSE_SHAPE': False, 'LAZY': False, 'PARSE': None}
         
         self.blocks = deserialize_blocks(
             swf=self,
             blocks_tpl=ret['blocks'],
             serializer_version=serializer_version)
         self.character_dict = self.get_character_dict()
+        self.indexes = {}
+        self.allocator = None
+        self.dirty = None
         return self
     loads = deserialize
 
     def copy(self):
         "コピーを作る（deepcopy）"
+        self.flush()
         new = Swf()
         new.rect = self.rect.copy()
         new.swf_head = self.swf_head
         new.swf_tail = self.swf_tail
-        new.flag = {'PARSE_SHAPE': False}
-        new.blocks = map(lambda b: b.copy(swf=new), self.blocks)
+        new.flag = {
+            'PARSE_SHAPE': False,
+            'LAZY': self.flag['LAZY'],
+            'PARSE': self.flag['PARSE']}
+        new.blocks = copy_blocks(self.blocks, swf=new)
         new.character_dict = new.get_character_dict()
+        # 索引は new で参照された時に作り直す
         return new
 
+    def get_index(self, klass):
+        "klass (BlockIndex のサブクラス) の索引を返す. 最初に参照された時に作る"
+        index = self.indexes.get(klass)
+        if index is None:
+            index = self.indexes[klass] = klass(self)
+        return index
+
+    def index_add(self, blocks, parent=None):
+        "blocks を追加, 変更した後に作成済みの索引を更新する"
+        for index in self.indexes.values():
+            index.add_blocks(blocks, parent)
+
+    def index_remove(self, blocks, parent=None):
+        "blocks を削除, 変更する前に作成済みの索引から除く"
+        for index in self.indexes.values():
+            index.remove_blocks(blocks, parent)
+
+    def index_update(self, block):
+        "block の内容が変わった後に作成済みの索引を更新する"
+        for index in self.indexes.values():
+            index.update(block)
+
+    @property
+    def name_index(self):
+        return self.get_index(NameIndex)
+
+    @property
+    def reference_index(self):
+        return self.get_index(ReferenceIndex)
+
+    @property
+    def tag_index(self):
+        return self.get_index(TagIndex)
+
+    @property
+    def hash_index(self):
+        return self.get_index(HashIndex)
+
+    @property
+    def dependency_graph(self):
+        return self.get_index(DependencyGraph)
+
+    @property
+    def sprite_hash_index(self):
+        return self.get_index(SpriteHashIndex)
+
+    def is_referenced(self, character_id):
+        "character_id を配置している PlaceObject2 があるかどうか"
+        return self.reference_index.is_referenced(character_id)
+
     def get_character_dict(self):
         # DefinitionTag を列挙する
+        if isinstance(self.blocks, LazyBlocks):
+            return LazyCharacterDict(self.blocks)
         ret = {}
         for block in self.blocks:
             if isinstance(block, DefinitionTag):
@@ -140,11 +282,7 @@ class Swf(StreamIO):
         """
         MovieClip 名を出力する
         """
-        ret = []
-        for p in self.search_tags('PlaceObject2'):
-            if hasattr(p, 'name'):
-                ret.append(p.name)
-        return ret
+        return list(self.name_index.iter_names())
 
     def get_movie_clip(self, mc_name):
         """
@@ -152,12 +290,7 @@ class Swf(StreamIO):
         MovieClip の名前はそれを参照している PlaceObject2 の
         name に入っているので PlaceObject2 を参照する
         """            
-        place_object2 = None
-        for p in self.search_tags('PlaceObject2'):
-            if hasattr(p, 'name'):
-                if p.name == mc_name:
-                    place_object2 = p
-                    break
+        place_object2, parent = self.name_index.get(mc_name)
         if place_object2:
             return MovieClip(
                 swf=self,
@@ -172,23 +305,15 @@ class Swf(StreamIO):
         """
         親 MovieClip 内に含まれる 子 MovieClip を取得する
         """
-        parent_mc_place_objecet2, child_mc_place_object2 = None, None
-        for p in self.search_tags('PlaceObject2'):
-            if hasattr(p, 'name'):
-                if p.name == parent_mc_name:
-                    parent_mc_place_object2 = p
-                    break
+        parent_mc_place_object2, parent = self.name_index.get(parent_mc_name)
         if not parent_mc_place_object2:
             raise MovieClipDoesNotExist(
                 'Parent MovieClip \"%s\" does not exist!' % parent_mc_name)
         parent_define_sprite = self.character_dict[
             parent_mc_place_object2.target_character_id]
-        
-        for tag in parent_define_sprite.blocks:
-            if isinstance(tag, PlaceObject2) and hasattr(tag, 'name'):
-                if tag.name == child_mc_name:
-                    child_mc_place_object2 = tag
-                    break
+
+        child_mc_place_object2, parent = self.name_index.get(
+            child_mc_name, parent_define_sprite)
         if child_mc_place_object2:
             return MovieClip(
                 swf=self,
@@ -201,6 +326,35 @@ class Swf(StreamIO):
                 'Child MovieClip \"%s\" in Parent MovieClip \"%s\" does not exist!'
                 % (child_mc_name, parent_mc_name))
 
+    def find(self, path):
+        """
+        'parent/child/grandchild' のように / で区切った名前で MovieClip を取得する
+        最初の名前は Swf.blocks 直下 (メインのタイムライン) から探す
+        名前には fnmatch の *, ?, [] が使え、合うものが複数あれば最初のものを返す
+        """
+        for mc in self.iter_find(path):
+            return mc
+        raise MovieClipDoesNotExist(
+            'MovieClip \"%s\" does not exist!' % path)
+
+    def find_all(self, path):
+        """
+        path に合う MovieClip を全て取得する
+        ex. swf.find_all('*/button_*')
+        """
+        return list(self.iter_find(path))
+
+    def iter_find(self, path):
+        def walk(parent, names):
+            for po2 in self.name_index.match(names[0], parent):
+                dt = self.character_dict.get(po2.target_character_id)
+                if len(names) == 1:
+                    yield MovieClip(swf=self, define_sprite=dt, place_object2=po2)
+                elif isinstance(dt, DefineSprite):
+                    for mc in walk(dt, names[1:]):
+                        yield mc
+        return walk(None, path.strip('/').split('/'))
+
     def replace_shape(self, old_shape, new_shape):
         """
         DefineShape (2,3,4) の置き換えを行う
@@ -210,36 +364,41 @@ class Swf(StreamIO):
         old_shape_index = self.blocks.index(old_shape)
         old_shape_id = old_shape.character_id
 
-        new_shape = new_shape.copy()
+        new_shape = new_shape.copy(swf=self)
         new_shape.set_character_id(old_shape_id)
+        self.index_remove([old_shape])
         self.blocks[old_shape_index] = new_shape
+        self.character_dict[old_shape_id] = new_shape
+        self.index_add([new_shape])
         return new_shape
 
     def get_same_definition_tag(self, new_dt):
         """
         new_dt と同じ DefinitionTag が存在するかどうか調べる
+        DefineSprite は new_dt の Swf での構造的なハッシュで比べる
         """
-        for character_id, dt in self.character_dict.items():
+        if isinstance(new_dt, DefineSprite):
+            if new_dt.swf is None:
+                return None
+            digest = new_dt.swf.sprite_hash_index.structural_hash(new_dt)
+            for ds in self.sprite_hash_index.get(digest):
+                return ds.character_id
+            return None
+        for dt in self.hash_index.get(new_dt.hash):
             if is_same_definition_tags(dt, new_dt):
-                return character_id
+                return dt.character_id
         return None
 
-    def get_all_definition_tags(self, ds, depth=1, dts=defaultdict(set)):
+    def get_all_definition_tags(self, ds, depth=1, dts=None):
         """
         DefineSprite(ds) 内の DefinitionTag を全て列挙する
+        階層の深さ -> character_id の set を返す
         """
-        for block in ds.blocks:
-            if isinstance(block, PlaceObject2) and block.target_character_id != None:
-                ch_id = block.target_character_id
-                if not ch_id in flatten_defaultdict_set(dts):
-                    dts[depth].add(ch_id)
-                    if not ch_id in self.character_dict:  # ???
-                        continue
-                    if isinstance(self.character_dict[ch_id], DefineSprite):
-                        self.get_all_definition_tags(
-                            self.character_dict[ch_id],
-                            depth + 1,
-                            dts)
+        if dts is None:
+            dts = defaultdict(set)
+        found = flatten_defaultdict_set(dts)
+        for d, layer in self.dependency_graph.layers(ds).iteritems():
+            dts[depth + d - 1].update(ch_id for ch_id in layer if ch_id not in found)
         return dts
 
     def insert_definition_tag(self, new_dt, before_dt):
@@ -250,10 +409,9 @@ class Swf(StreamIO):
         new_dt = new_dt.copy(swf=self)
         new_dt.set_character_id(new_dt_id)
         mc_index = self.blocks.index(before_dt)
-        self.blocks = \
-            self.blocks[:mc_index] + [new_dt] + \
-            self.blocks[mc_index:]
+        self.blocks.insert(mc_index, new_dt)
         self.character_dict[new_dt_id] = new_dt
+        self.index_add([new_dt])
         return new_dt_id
 
     def replace_movie_clip(self, old_mc, new_mc):
@@ -268,13 +426,14 @@ class Swf(StreamIO):
         old_mc.get_place_object2()
 
         ds_index = self.blocks.index(old_mc.define_sprite)
-        new_ds = new_mc.define_sprite.copy(new_mc.swf)
+        new_ds = new_mc.define_sprite.copy(self)
 
         # new_mc の DefineSprite を間に追加する
         self.blocks.insert(ds_index, new_ds)
         new_ds_id = self.get_new_character_id()
         self.character_dict[new_ds_id] = new_ds
         new_ds.set_character_id(new_ds_id)
+        self.index_add([new_ds])
 
         old_mc.place_object2.set_target_character_id(new_ds_id)
         if old_mc.place_object2.base_block:
@@ -292,18 +451,28 @@ class Swf(StreamIO):
     def vanish_movie_clip(self, mc):
         # MovieClip を画面上の参照画像も含めて削除する
         # self.blocks から削除すればファイルには含まれなくなる
+        # 内部で参照している DefinitionTag は、他から参照されていなければ削除する
+
+        # 取り除いた character_id は、どこからも配置されていなければ再利用する
+        def remove_definition_tag(swf, dt):
+            swf.index_remove([dt])
+            swf.blocks.remove(dt)
+            if not swf.is_referenced(dt.character_id):
+                swf.release_character_id(dt.character_id)
 
         def vanish_define_sprite(swf, ds):
-            for block in ds.blocks:
-                if isinstance(block, PlaceObject2) and block.target_character_id:
-                    dt = swf.character_dict[block.target_character_id]
-                    if isinstance(dt, DefineSprite):
-                        vanish_define_sprite(swf, dt)
-                    else:
-                        if dt in swf.blocks:
-                            swf.blocks.remove(dt)
+            # ds を取り除くと依存グラフからも消えるので先に取り出しておく
+            deps = swf.dependency_graph.get_block_deps(ds)
             if ds in swf.blocks:
-                swf.blocks.remove(ds)
+                remove_definition_tag(swf, ds)
+            for ch_id in deps:
+                if not ch_id or swf.is_referenced(ch_id):
+                    continue
+                dt = swf.character_dict.get(ch_id)
+                if isinstance(dt, DefineSprite):
+                    vanish_define_sprite(swf, dt)
+                elif dt in swf.blocks:
+                    remove_definition_tag(swf, dt)
         vanish_define_sprite(self, mc.define_sprite)
 
     def replace_movie_clip_with_vanishing(self, old_mc, new_mc):
@@ -321,6 +490,7 @@ class Swf(StreamIO):
         def delete_mc_place_object2(mc):
             po2 = mc.place_object2
             base_block = po2.base_block
+            self.index_remove([po2], base_block)
             if base_block:
                 base_block.blocks.remove(po2)
                 base_block.update_value()
@@ -330,29 +500,216 @@ class Swf(StreamIO):
         if isinstance(mc, str):
             mc = self.get_movie_clip(mc)
             delete_mc_place_object2(mc)
-        elif isintance(mc, MovieClip):
-            if mc.place_object2:
-                delete_mc_place_object2(mc)
-                self.blocks.remove(mc.place_object2)
-            else:
+        elif isinstance(mc, MovieClip):
+            if not mc.place_object2:
                 mc.get_place_object2()
-                delete_mc_place_object2(mc)
+            delete_mc_place_object2(mc)
+
+    def collect_garbage(self):
+        """
+        メインのタイムラインの PlaceObject2 や書き出されたキャラクターから
+        辿れない DefinitionTag を取り除き、取り除いた character_id の list を返す
+        参照先を調べられないタグがある場合は何も取り除かない
+        """
+        roots = []
+        attached = defaultdict(list)   # character_id -> それと一緒に残す character_id
+        heads = []
+        for i in xrange(len(self.blocks)):
+            tag, ch_id = get_block_head(self.blocks, i)
+            heads.append((tag, ch_id))
+            if tag in (4, 15, 26):   # PlaceObject, StartSound, PlaceObject2
+                placed = read_placed_id(self.blocks[i])
+                if placed is not None:
+                    roots.append(placed[1])
+            elif tag in (56, 76):   # ExportAssets, SymbolClass
+                roots.extend(e[1] for e in read_exported_ids(self.blocks[i]))
+            elif tag == 17:   # DefineButtonSound
+                attached[ch_id].extend(e[1] for e in read_button_sound_ids(self.blocks[i]))
+            elif tag not in DEFINITION_TAGS and tag not in ATTACHED_TAGS \
+                    and tag not in CONTROL_TAGS:
+                return []
+
+        # mark
+        reachable = set()
+        stack = roots
+        while stack:
+            ch_id = stack.pop()
+            if ch_id in reachable:
+                continue
+            reachable.add(ch_id)
+            stack.extend(attached.get(ch_id, ()))
+            dt = self.character_dict.get(ch_id)
+            if dt is not None:
+                refs = get_references(dt)
+                if refs is None:
+                    return []
+                stack.extend(refs)
+
+        # sweep
+        removed = set(i for i, (tag, ch_id) in enumerate(heads)
+                      if (tag in DEFINITION_TAGS or tag in ATTACHED_TAGS)
+                      and ch_id not in reachable)
+        if not removed:
+            return []
+        self._remove_root_blocks(removed)
+        ret = sorted(set(heads[i][1] for i in removed if heads[i][0] in DEFINITION_TAGS))
+        for ch_id in ret:
+            self.release_character_id(ch_id)
+        return ret
+
+    @contextmanager
+    def batch(self):
+        """
+        with swf.batch(): の中では DefineSprite.update_value を遅らせ、
+        抜ける時に変更された DefineSprite をそれぞれ 1 回だけ更新する
+        中で DefineSprite の value を参照する場合は先に flush を呼ぶ
+        """
+        if self.dirty is not None:
+            # 入れ子の場合は一番外側でまとめて更新する
+            yield self
+            return
+        self.dirty = OrderedDict()
+        try:
+            yield self
+        finally:
+            self.flush()
+            self.dirty = None
+
+    def flush(self):
+        "batch の中で変更された DefineSprite を更新する"
+        if not self.dirty:
+            return
+        dirty = self.dirty.values()
+        self.dirty = None
+        try:
+            for ds in dirty:
+                ds.update_value()
+        finally:
+            self.dirty = OrderedDict()
+
+    def _remove_root_blocks(self, removed):
+        "Swf.blocks から removed (位置の set) のタグを取り除く"
+        if self.indexes:
+            self.index_remove([self.blocks[i] for i in sorted(removed)])
+        items = self.blocks.items if isinstance(self.blocks, LazyBlocks) else self.blocks
+        items[:] = [item for i, item in enumerate(items) if i not in removed]
+
+    def dedupe_definitions(self):
+        """
+        内容 (タグと character_id 以降のバイト列) が同じ DefinitionTag を最初のものにまとめる
+        参照している PlaceObject2 などの character_id を書き換えてから取り除き、
+        {取り除いた character_id: 残した character_id} を返す
+        まとめたことで内容が同じになった DefinitionTag (ex. 同じビットマップを
+        参照するようになった DefineShape, 同じシェイプを配置するようになった DefineSprite) もまとめる
+        参照先を書き換えられないタグがある場合は何もしない
+        """
+        ret = {}
+        while True:
+            self.flush()   # batch の中でも DefineSprite のバイト列で比べる
+            mapping = self.find_duplicate_definitions()
+            if not mapping or not self.replace_character_ids(mapping):
+                return ret
+            self._remove_root_blocks(set(
+                i for i, block in enumerate(self.blocks)
+                if isinstance(block, DefinitionTag) and block.character_id in mapping))
+            for ch_id in mapping:
+                self.release_character_id(ch_id)
+            for ch_id, new_id in ret.items():
+                ret[ch_id] = mapping.get(new_id, new_id)
+            ret.update(mapping)
+
+    def find_duplicate_definitions(self):
+        """
+        内容が同じ DefinitionTag の {後の character_id: 最初の character_id}
+        ハッシュが同じでも (crc32_digest などは衝突しうる) バイト列が違えばまとめない
+        DefineFontName などが付いているものと、ExportAssets, SymbolClass で
+        名前が付いているものは除く
+        DefineSprite もバイト列で比べる. 内部で配置しているものは前の回でまとめてあるので
+        SpriteHashIndex の構造的なハッシュを使わなくても、同じものはバイト列も同じになる
+        """
+        excluded = set()
+        for i in xrange(len(self.blocks)):
+            tag, ch_id = get_block_head(self.blocks, i)
+            if tag in ATTACHED_TAGS or tag == 88:   # DefineFontName
+                excluded.add(ch_id)
+            elif tag in (56, 76):   # ExportAssets, SymbolClass
+                excluded.update(e[1] for e in read_exported_ids(self.blocks[i]))
+        first = defaultdict(list)   # (タグ, ハッシュ) -> [DefinitionTag, ...]
+        ret = {}
+        for block in self.blocks:
+            if not isinstance(block, DefinitionTag) or block.tag == 88 \
+                    or block.character_id in excluded:
+                continue
+            candidates = first[(block.tag, block.hash)]
+            for dt in candidates:
+                if is_same_definition_tags(dt, block):
+                    ret[block.character_id] = dt.character_id
+                    break
+            else:
+                candidates.append(block)
+        return ret
+
+    def replace_character_ids(self, mapping):
+        """
+        Swf 内で参照している character_id を mapping {古い ID: 新しい ID} に従って置き換える
+        参照先を調べられないタグがある場合は何もせずに False を返す
+        """
+        for i in xrange(len(self.blocks)):
+            tag, ch_id = get_block_head(self.blocks, i)
+            if tag in DEFINITION_TAGS:
+                if get_references(self.blocks[i]) is None:
+                    return False
+            elif tag not in (4, 15, 26, 56, 76) and tag not in ATTACHED_TAGS \
+                    and tag not in CONTROL_TAGS:
+                return False
+
+        for block in self.blocks:
+            if isinstance(block, DefinitionTag):
+                parsed = get_parsed_definition(block)
+                if parsed.replace_references(mapping) and parsed is not block:
+                    block.value = parsed.value
+            elif block.tag in (56, 76):
+                replace_uint16s(block, read_exported_ids(block), mapping)
+            elif block.tag == 17:
+                replace_uint16s(block, read_button_sound_ids(block), mapping)
+            else:
+                replace_placed_id(block, mapping)
+        return True
 
     def get_new_character_id(self):
         """
         SWF 内で用いられていない character_id を取得する
-        現状 character_id には最大 2 ** 16 - 1 = 65535 の ID を振ることができるので、
-        とりあえず現状の character_id の中の最大を更新する形で取るようにしてみる
+        解放された character_id があればそれを使い、無ければ最大の ID の次を振る
         """
-        return max(self.character_dict) + 1
+        if self.allocator is None:
+            self.allocator = CharacterIdAllocator(self.character_dict)
+        return self.allocator.allocate()
+
+    def release_character_id(self, character_id):
+        """
+        Swf から取り除いた DefinitionTag の character_id を再利用できるようにする
+        """
+        if character_id not in self.character_dict:
+            return
+        if self.allocator is None:
+            # 取り除く前の character_dict から最大の ID を求める
+            self.allocator = CharacterIdAllocator(self.character_dict)
+        del self.character_dict[character_id]
+        self.allocator.release(character_id)
 
     def search_tags(self, tag_name, blocks = None):
         """
         タグ名のブロックを再帰的に探索する
+        blocks を指定しない場合は Swf 全体の索引 (tag_index) から返す
         """
-        ret = []
         if not blocks:
-            blocks = self.blocks
+            return list(self.iter_search_tags(tag_name))
+
+        ret = []
+        if isinstance(blocks, LazyBlocks) and tag_name in TAG_CODES:
+            # 該当するタグと DefineSprite だけをパースする
+            blocks = blocks.filter_tags(
+                (TAG_CODES[tag_name], TAG_CODES['DefineSprite']))
 
         for block in blocks:
             if block.__class__.__name__ == tag_name:
@@ -361,11 +718,20 @@ class Swf(StreamIO):
                 ret += self.search_tags(tag_name, block.blocks)
         return ret
 
+    def iter_search_tags(self, tag_name):
+        """
+        search_tags の list を作らない版
+        返している間はブロックの追加, 削除を行わないこと
+        """
+        for block, parent in self.tag_index.get(tag_name).itervalues():
+            yield block
+
     def search_root(self, tag_name):
         """
         タグ名のブロックを self.blocks のみで一段のみで調べる
         """
-        return filter(lambda b: b.__class__.__name__ == tag_name, self.blocks)
+        return [block for block, parent in self.tag_index.get(tag_name).itervalues()
+                if parent is None]
 
     def print_used_tags(self, blocks=None):
         if not blocks:
@@ -375,7 +741,7 @@ class Swf(StreamIO):
         for block in blocks:
             ret.add((block.tag, block.__class__.__name__))
             if hasattr(block, 'blocks'):
-                ret.union(self.print_used_tags(block.blocks))
+                ret |= self.print_used_tags(block.blocks)
         return ret
 
     def print_tags(self):
@@ -399,8 +765,9 @@ class Swf(StreamIO):
         self.frame_count = le2byte(self.read(2))
 
         # File Header（head）とその後の部分（tail）を分離する
-        self.swf_head = self.value[:self.pos]
-        self.swf_tail = self.value[self.pos:]
+        # tail はコピーせずに value を参照する
+        self.swf_head = self.buf[:self.pos]
+        self.swf_tail = view(self.buf, self.pos)
         
         if DEBUG:
             print " Swf Header ".center(60,'-')
@@ -418,66 +785,179 @@ class Swf(StreamIO):
 
     @property
     def size(self):
-        return (b2i(self.rect.x_max) / 20, b2i(self.rect.y_max) / 20)
+        return (self.rect.getattr_value('x_max') / 20, self.rect.getattr_value('y_max') / 20)
 
     @property
     def width(self):
-        return b2i(self.rect.x_max) / 20
+        return self.rect.getattr_value('x_max') / 20
 
     @property
     def height(self):
-        return b2i(self.rect.y_max) / 20
+        return self.rect.getattr_value('y_max') / 20
 
-    def update_file_header(self):
-        fl = len(self.swf_head)
-        for block in self.blocks:
-            fl += len(block)
+    def update_file_header(self, extra_length=0):
+        self.flush()   # batch の中でも DefineSprite を更新してから長さを数える
+        fl = len(self.swf_head) + sum(iter_block_lengths(self.blocks)) + extra_length
 
         self.swf_head = self.swf_head[:4] + _h32(fl) + self.swf_head[8:]
 
     def combine_blocks(self):
         self.update_file_header()
-        self.value = self.swf_head + ''.join(map(lambda b: b.value, self.blocks))
+        self.value = self.swf_head + ''.join(iter_block_values(self.blocks))
 
     def inject_params(self, params={}):
         self.inject_params_dict = params
 
-    def write(self, f=None):
-        # Output Swf
-        self.combine_blocks()
-
+    def iter_chunks(self, compress=None, level=zlib.Z_DEFAULT_COMPRESSION):
+        """
+        出力する SWF をヘッダーと各タグのバイト列に分けて順番に返す
+        全体を 1 つの文字列に結合しないので、そのまま f.write や
+        WSGI のレスポンスとして渡すことができる
+        FWS の場合、変更していないタグは読み込んだ SWF を参照する buffer のまま返す
+        (cStringIO の writelines や ''.join は buffer を受け付けないので注意)
+
+        compress: True なら CWS, False なら FWS で出力する
+                  None の場合は読み込んだ SWF と同じ形式にする
+        level: CWS の zlib の圧縮レベル
+        """
+        if compress is None:
+            compress = self.swf_head[:3] == 'CWS'
+        if not compress:
+            for chunk in self._iter_chunks('FWS'):
+                yield chunk
+            return
+
+        # file_length を含む最初の 8 byte 以外を圧縮する
+        chunks = self._iter_chunks('CWS')
+        head = chunks.next()
+        yield head[:8]
+        for chunk in iter_compress(itertools.chain([head[8:]], chunks), level):
+            yield chunk
+
+    def _iter_chunks(self, magic):
+        "magic を付けた非圧縮の SWF を返す"
         # inject params
+        # create_swf と同じく最初のタグ (SetBackgroundColor) の後に DoAction を追加する
+        params_tag = ''
         if self.inject_params_dict:
-            self.value = create_swf(self.value, self.inject_params_dict)
+            params_tag = _maketag(self.inject_params_dict, get_encode(self.swf_head))
 
-        if f:
-            f.write(self.value)
-        else:
+        self.update_file_header(len(params_tag))
+        yield magic + self.swf_head[3:]
+        for i, value in enumerate(iter_block_buffers(self.blocks)):
+            yield value
+            if i == 0 and params_tag:
+                yield params_tag
+
+    def write(self, f=None, compress=None, level=zlib.Z_DEFAULT_COMPRESSION, gc=False):
+        """
+        compress, level は iter_chunks を参照
+        gc: True なら出力する前に collect_garbage で参照されていないタグを取り除く
+        """
+        if gc:
+            self.collect_garbage()
+        # Output Swf
+        # chunk には buffer が含まれるので writelines ではなく write で書き出す
+        out = f or StringIO()
+        for chunk in self.iter_chunks(compress, level):
+            out.write(chunk)
+        if not f:
+            self.value = out.getvalue()
             return self.value
 
 
+def get_parsed_definition(dt):
+    "パースしていない DefinitionTag は、同じ buf を参照するタグのクラスにして返す"
+    if type(dt) is DefinitionTag and dt.tag in SWF_TAG:
+        return make_swfblock(dt.tag, dt.length, dt.content_offset, dt.buf)
+    return dt
+
+
+def get_references(dt):
+    "DefinitionTag の参照先. 調べられない場合は None"
+    return get_parsed_definition(dt).references()
+
+
+def read_exported_ids(block):
+    "ExportAssets, SymbolClass の (位置, character_id) の list"
+    block.set_pos(block.content_offset)
+    ret = []
+    for i in xrange(le2byte(block.read(2))):
+        ret.append((block.pos, le2byte(block.read(2))))
+        block.read_string()
+    return ret
+
+
+def read_button_sound_ids(block):
+    "DefineButtonSound の 4 つの状態の SoundChar の (位置, character_id) の list"
+    block.set_pos(block.content_offset + 2)
+    ret = []
+    for i in xrange(4):
+        offset = block.pos
+        sound_id = le2byte(block.read(2))
+        if not sound_id:
+            continue
+        ret.append((offset, sound_id))
+        # SOUNDINFO
+        flags = ord(block.read(1))
+        if flags & 0x01:   # HasInPoint
+            block.read(4)
+        if flags & 0x02:   # HasOutPoint
+            block.read(4)
+        if flags & 0x04:   # HasLoops
+            block.read(2)
+        if flags & 0x08:   # HasEnvelope
+            block.read(8 * ord(block.read(1)))
+    return ret
+
+
+class CharacterIdAllocator(object):
+    """
+    新しい character_id を振る
+    振った中で最大の ID と、解放された ID の list を持つ
+    """
+    def __init__(self, character_ids):
+        self.high = max(character_ids) if character_ids else 0
+        self.free = []
+
+    def allocate(self):
+        if self.free:
+            return self.free.pop()
+        if self.high >= MAX_CHARACTER_ID:
+            raise CharacterIdExhausted(
+                "character_id exceeds %d" % MAX_CHARACTER_ID)
+        self.high += 1
+        return self.high
+
+    def release(self, character_id):
+        if character_id <= self.high:
+            self.free.append(character_id)
+
+
 def is_same_definition_tags(ds1, ds2):
     if ds1.hash != ds2.hash:
         return False
     else:
-        if isinstance(ds1, DefineSprite) and isinstance(ds2, DefineSprite):
+        if isinstance(ds1, DefineSprite) and isinstance(ds2, DefineSprite) \
+                and ds1.swf is not ds2.swf:
             """
             この場合は DefineSprite 同士が本当に同じか、
             blocks 内の PlaceObject2 の参照先を見ていき詳細に調べる必要がある
 
-            しかしそれには深いところまでパースする必要があるため、
-            アニメーション自体が同じかどうか決定するのを放棄する。
-            Swf の容量は若干重たくなるが、置き換えの計算は高速になる
+            それには参照先の Swf が必要なので、ここでは決定するのを放棄する。
+            Swf.get_same_definition_tag は SpriteHashIndex の構造的なハッシュで比べる
             """
             return False
         else:
-            return True
+            # ハッシュ関数によっては衝突するので、character_id 以降のバイト列も比べる
+            return ds1.tag == ds2.tag and \
+                ds1.buf[(ds1.content_offset + 2):] == ds2.buf[(ds2.content_offset + 2):]
 
 
 if __name__ == '__main__':
-    tank = Swf(open('sample/mc/tank.swf').read())
-    fish_white = Swf(open('sample/mc/fish_white.swf').read())
-    fish_red = Swf(open('sample/mc/fish_red.swf').read())
+    tank = Swf.open('sample/mc/tank.swf')
+    fish_white = Swf.open('sample/mc/fish_white.swf')
+    fish_red = Swf.open('sample/mc/fish_red.swf')
 
     mc_white = fish_white.get_movie_clip('white')
     mc_red = fish_red.get_movie_clip('red')
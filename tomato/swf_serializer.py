@@ -36,6 +36,6 @@ if __name__ == '__main__':
         print "usage: python swf_serializer.py [input.swf] [out.p]"
         sys.exit(1)
 
-    input_swf = Swf(open(sys.argv[1]).read())
+    input_swf = Swf.open(sys.argv[1])
     input_swf.dumps(open(sys.argv[2], 'w'))
 
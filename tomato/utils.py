@@ -27,6 +27,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 import struct
+from binascii import hexlify, unhexlify
 from bitarray import bitarray
 from array import array
 from math import ceil
@@ -75,34 +76,99 @@ def _oct_ceil(num):
 Bit Values
 """
 def _bin(num):
+    return bitarray(bin(num)[2:], endian='big')
+
+
+def bit_length(num):
+    "num (>= 0) を表すのに必要な bit 数 (0 は 1 bit)"
+    return len(bin(num)) - 2
+
+
+def to_signed(num, bits):
+    "bits bit の 2 の補数 num を符号付き整数にする"
+    if bits and num >> (bits - 1):
+        return num - (1 << bits)
+    return num
+
+
+def read_ub(buf, bpos, num):
+    """
+    buf の bpos bit 目から num bit を読み、符号無し整数として返す
+    必要なバイトだけを整数にして、シフトとマスクで取り出す
+    """
     if num == 0:
-        ret = bitarray('0', endian='big')
-    else:
-        ret = bitarray(endian='big')
-        nums = array('B')
-        while num != 0:
-            nums.append(num % 256)
-            num >>= 8
-        for n in reversed(nums):
-            ret.fromstring(chr(n))
-        ret = _bit_cut(ret)
-    return ret
+        return 0
+    first = bpos >> 3
+    last = (bpos + num + 7) >> 3
+    s = buf[first:last]
+    if len(s) < last - first:
+        raise BitsError('len(value): %d < bit pos: %d' % (len(buf), bpos + num))
+    return (int(hexlify(s), 16) >> ((last << 3) - bpos - num)) & ((1 << num) - 1)
+
+
+class BitReader(object):
+    "バイト列 buf を bit 単位で整数として読み込む"
+    __slots__ = ('buf', 'bpos')
+
+    def __init__(self, buf, bpos=0):
+        self.buf = buf
+        self.bpos = bpos
+
+    def read_bits(self, num):
+        "UB[num]"
+        ret = read_ub(self.buf, self.bpos, num)
+        self.bpos += num
+        return ret
+
+    def read_sbits(self, num):
+        "SB[num]"
+        return to_signed(self.read_bits(num), num)
+
+    def read_fbits(self, num):
+        "FB[num]"
+        return self.read_sbits(num) / float(1 << 16)
+
+    def get_bits(self, num):
+        "bpos を進めずに num bit を読む"
+        return read_ub(self.buf, self.bpos, num)
+
+    def align_byte(self):
+        self.bpos = _oct(self.bpos)
 
 
-def _bit_cut(b):
+class BitWriter(object):
+    "整数を bit 単位で書き込み、バイト列にする"
+    __slots__ = ('acc', 'length')
+
+    def __init__(self):
+        self.acc = 0
+        self.length = 0
+
+    def write_bits(self, num, bits):
+        "num の下位 bits bit を書き込む (負の数は 2 の補数になる)"
+        self.acc = (self.acc << bits) | (num & ((1 << bits) - 1))
+        self.length += bits
+
+    def __len__(self):
+        return self.length
+
+    def tostring(self):
+        "最後のバイトの残りは 0 で埋める"
+        size = _oct_ceil(self.length)
+        if size == 0:
+            return ''
+        return unhexlify('%0*x' % (size * 2, self.acc << (size * 8 - self.length)))
+
+
+def view(s, offset=0, size=None):
     """
-    文字から bit 列に直す際に0が残ってしまうので
-    最初に出現する 0 のビット列を消す
-    文字 C (99): 01000011
-               -> 1000011
+    s (str, mmap, buffer) の offset から size byte をコピーせずに参照する
+    buffer の buffer は元のオブジェクトを直接参照するので、
+    入れ子になっても 1 つのバッファを共有し続ける
     """
-    pos = -1
-    for i, f in enumerate(b):
-        if not f:
-            pos = i
-        else:
-            break
-    return b[(pos + 1):]
+    if size is None:
+        return buffer(s, offset)
+    return buffer(s, offset, size)
 
 
 def string2bits(s):
@@ -113,10 +179,24 @@ s2b = string2bits
 
 
 def bin2int(l):
-    return reduce(lambda a, b: a + a + b, l, 0)
+    if not len(l):
+        return 0
+    return int(l.to01(), 2)
 b2i = bin2int
 
 
+def fields2string(bits):
+    "FieldsIO の attribute (値, bit 数) を '0101' の形にする"
+    num, length = bits
+    if length == 0:
+        return ''
+    return bin(num)[2:].zfill(length)
+
+
+def string2fields(s):
+    return (int(s, 2) if s else 0, len(s))
+
+
 def flatten_defaultdict_set(defaultdict_set):
     x = set()
     for ds in defaultdict_set.values():
@@ -152,6 +232,172 @@ def bits2string(bits):
 b2s = bits2string
 
 
+class FieldsCompiler(object):
+    """
+    FieldsIO の _fields_ から parse, make_restrictions, generate_bits,
+    value, serialize を、_fields_ を辿らずに直接実行する関数として生成する
+    生成する関数は FieldsIO の汎用の関数と同じ結果を返す
+    """
+    def __init__(self, fields, types, slots):
+        self.fields = fields
+        self.types = types
+        self.slots = slots
+        self.lines = []
+        # 長さや条件として参照される attribute
+        self.refs = set()
+        for attr, ctrl, stat in self.walk(fields):
+            if isinstance(ctrl, int):
+                self.refs.add(attr)
+            elif isinstance(stat, str):
+                self.refs.add(stat)
+
+    def walk(self, fields):
+        for attr, ctrl, stat in fields:
+            yield attr, ctrl, stat
+            if isinstance(ctrl, int):
+                for f in self.walk(stat):
+                    yield f
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def compile(self):
+        self.emit(0, 'def parse(self, block):')
+        self.emit(1, 'read_bits = block.read_bits')
+        self.emit_parse(self.fields, 1, set())
+
+        self.emit(0, 'def make_restrictions(self, fields=None):')
+        self.emit(1, 'if fields:')
+        self.emit(2, 'return FieldsIO.make_restrictions(self, fields)')
+        self.emit(1, 'self.rests = {}')
+        self.emit_restrictions(self.fields, 1)
+
+        self.emit(0, 'def generate_bits(self):')
+        self.emit(1, 'self.make_restrictions()')
+        self.emit(1, 'rests = self.rests')
+        for attr, stat in self.aligned_attrs():
+            self.emit(1, 'if %r in rests:' % attr)
+            if isinstance(stat, str):
+                align = 'T_%s.read(self.%s)' % (stat, stat)
+            else:
+                align = '%d' % stat
+            self.emit(2, 'self.%s = T_%s.write(T_%s.read(self.%s), %s)' % (
+                attr, attr, attr, attr, align))
+
+        self.emit(0, 'def value(self):')
+        self.emit(1, 'w = BitWriter()')
+        for attr in self.slots:
+            self.emit(1, 'if self.%s is not None:' % attr)
+            self.emit(2, 'w.write_bits(*self.%s)' % attr)
+        self.emit(1, 'return w.tostring()')
+
+        self.emit(0, 'def serialize(self):')
+        self.emit(1, 'return [')
+        for attr in self.slots:
+            self.emit(2, 'f2s(self.%s) if self.%s is not None else None,' % (attr, attr))
+        self.emit(2, ']')
+
+        namespace = {
+            'FieldsIO': FieldsIO,
+            'BitWriter': BitWriter,
+            'f2s': fields2string,
+            }
+        for attr, klass in self.types.items():
+            namespace['T_%s' % attr] = klass
+        source = '\n'.join(self.lines) + '\n'
+        exec source in namespace
+        return {
+            'parse': namespace['parse'],
+            'make_restrictions': namespace['make_restrictions'],
+            'generate_bits': namespace['generate_bits'],
+            'value': property(namespace['value']),
+            'serialize': namespace['serialize'],
+            '_fields_source_': source,
+            }
+
+    def emit_parse(self, fields, indent, local_values):
+        "local_values: その位置で既にローカル変数 v_attr に読み込まれている attribute"
+        local_values = set(local_values)
+
+        def read_value(attr):
+            if attr in local_values:
+                return 'v_%s' % attr
+            return 'T_%s.read(self.%s)' % (attr, attr)
+
+        for attr, ctrl, stat in fields:
+            if isinstance(ctrl, int):   # 条件文
+                self.emit(indent, 'if %s == %d:' % (read_value(attr), ctrl))
+                self.emit_parse(stat, indent + 1, local_values)
+                self.emit(indent, 'else:')
+                for a, c, s in stat:
+                    self.emit(indent + 1, 'self.%s = None' % a)
+                continue
+
+            if isinstance(stat, int):   # 固定長
+                if stat == 0:
+                    self.emit(indent, 'self.%s = (0, 1)' % attr)
+                else:
+                    self.emit(indent, 'self.%s = (read_bits(%d), %d)' % (attr, stat, stat))
+            else:   # 可変長
+                if stat in local_values:
+                    n = 'v_%s' % stat
+                else:
+                    n = 'n'
+                    self.emit(indent, 'n = %s' % read_value(stat))
+                self.emit(indent, 'self.%s = (read_bits(%s), %s) if %s else (0, 1)' % (
+                    attr, n, n, n))
+            if attr in self.refs:
+                self.emit(indent, 'v_%s = T_%s.read(self.%s)' % (attr, attr, attr))
+                local_values.add(attr)
+
+    def emit_restrictions(self, fields, indent):
+        for attr, ctrl, stat in reversed(fields):
+            if isinstance(ctrl, int):
+                "条件文内の attr がすでに存在していればあらかじめ bit 値を生成しておく"
+                self.emit(indent, 'self.%s = (0, 1)' % attr)
+                self.emit(indent, 'if %s:' % ' or '.join(
+                    'getattr(self, %r, None) is not None' % a for a, c, s in stat))
+                self.emit(indent + 1, 'self.%s = (1, 1)' % attr)
+                self.emit_restrictions(stat, indent)
+                continue
+
+            if stat == 1:   # flag は上記で設定しているので制約条件は設定しない
+                self.emit(indent, 'if getattr(self, %r, None) is None:' % attr)
+                self.emit(indent + 1, 'self.%s = None' % attr)
+                continue
+
+            self.emit(indent, 'if getattr(self, %r, None) is not None:' % attr)
+            self.emit(indent + 1, 'self.rests[%r] = %r' % (attr, stat))
+            if isinstance(stat, str):
+                self.emit(indent + 1, 'if getattr(self, %r, None) is None:' % stat)
+                self.emit(indent + 2, 'self.%s = T_%s.write(0)' % (stat, stat))
+                self.emit(indent + 1,
+                    'self.%s = T_%s.write(max(T_%s.read(self.%s), self.%s[1]))' % (
+                        stat, stat, stat, stat, attr))
+            self.emit(indent, 'else:')
+            self.emit(indent + 1, 'self.%s = None' % attr)
+
+    def aligned_attrs(self):
+        ret = []
+        for attr, ctrl, stat in self.walk(self.fields):
+            if not isinstance(ctrl, int) and stat != 1 and (attr, stat) not in ret:
+                ret.append((attr, stat))
+        return ret
+
+
+class FieldsIOMeta(type):
+    "_fields_ を持つクラスを作成する際に、FieldsCompiler で専用の関数を生成する"
+    def __new__(mcs, name, bases, attrs):
+        if '_fields_' in attrs:
+            compiled = FieldsCompiler(
+                attrs['_fields_'],
+                attrs['_types_'],
+                attrs['__slots__']).compile()
+            for k, v in compiled.items():
+                attrs.setdefault(k, v)
+        return type.__new__(mcs, name, bases, attrs)
+
+
 class FieldsIO(object):
     """
     FieldsIO を継承することで BitFields 等を
@@ -167,7 +413,11 @@ class FieldsIO(object):
       - Type だと attribute を status に従って read or write
       - 数値 だと 条件式となり、attribute == controller で、
         status の文が実行される
+
+    _fields_ を持つサブクラスは、クラス作成時に FieldsCompiler によって
+    parse 等の関数が _fields_ 専用に生成されたものに置き換わる
     """
+    __metaclass__ = FieldsIOMeta
     __slots__ = ('rests', )
     def parse(self, block):
         self.parse_fields(self._fields_, block)
@@ -193,9 +443,9 @@ class FieldsIO(object):
                     bit_len = self.getattr_value(stat)
                 
                 if bit_len == 0:
-                    self.setattr_bit(attr, bitarray('0', endian='big'))
+                    self.setattr_bit(attr, (0, 1))
                 else:
-                    self.setattr_bit(attr, block.read_bits(bit_len))
+                    self.setattr_bit(attr, (block.read_bits(bit_len), bit_len))
 
     def generate_bits(self):
         "構造体のビット列を生成する"
@@ -213,10 +463,10 @@ class FieldsIO(object):
         for attr, ctrl, stat in reversed(fields):
             if isinstance(ctrl, int):
                 "条件文内の attr がすでに存在していればあらかじめ bit 値を生成しておく"
-                self.setattr_bit(attr, bitarray('0', endian='big'))   # False
+                self.setattr_bit(attr, (0, 1))   # False
                 for a, c, s in stat:
                     if hasattr(self, a) and self.getattr_bit(a) != None:
-                        self.setattr_bit(attr, bitarray('1', endian='big'))   # True
+                        self.setattr_bit(attr, (1, 1))   # True
                         break
                 self.make_restrictions(stat)
             elif hasattr(self, attr) and getattr(self, attr) != None:
@@ -235,7 +485,7 @@ class FieldsIO(object):
                     self.setattr_value(
                         stat,
                         max(self.getattr_value(stat),
-                            len(self.getattr_bit(attr))))
+                            self.getattr_bit(attr)[1]))
             else:
                 setattr(self, attr, None)
 
@@ -258,10 +508,12 @@ class FieldsIO(object):
 
     @property
     def value(self):
-        ret = bitarray(endian='big')
-        for b in filter(lambda a: a, map(lambda x: getattr(self, x), self.__slots__)):
-            ret.extend(b)
-        return b2s(ret)
+        w = BitWriter()
+        for attr in self.__slots__:
+            bits = getattr(self, attr)
+            if bits is not None:
+                w.write_bits(*bits)
+        return w.tostring()
 
     @property
     def length(self):
@@ -286,68 +538,64 @@ class FieldsIO(object):
     def serialize(self):
         ret = []
         for t in [getattr(self, attr) for attr in self.__slots__]:
-            if not t:
+            if t is None:
                 ret.append(None)
             else:
-                ret.append(t.to01())
+                ret.append(fields2string(t))
         return ret
 
     def deserialize(self, tpl):
         for i, attr in enumerate(self.__slots__):
             if tpl[i]:
-                setattr(self, attr, bitarray(tpl[i], endian='big'))
+                setattr(self, attr, string2fields(tpl[i]))
             else:
                 setattr(self, attr, None)
         return self
 
 
+# FieldsIO の attribute は (bit 列を符号無し整数にした値, bit 数) で持つ
 class UB(object):
     @classmethod
     def read(cls, val):
-        return b2i(val)
+        return val[0]
 
     @classmethod
     def write(cls, num, align=None):
-        raw_bits = _bin(num)
+        if num < 0:
+            raise NegativeIntError('UB can not hold negative number: %d' % num)
+        raw_bits = (num, bit_length(num))
         if align == None: return raw_bits
         else: return cls.align(raw_bits, align)
 
     @classmethod
     def align(cls, bits, align):
-        if align < len(bits):
-            raise AlignError('Illegal align number: %d -> %d' % (len(bits), align))
+        if align < bits[1]:
+            raise AlignError('Illegal align number: %d -> %d' % (bits[1], align))
         else:
-            return bitarray('0' * (align - len(bits)), endian='big') + bits
+            return (bits[0], align)
 
 
 class SB(object):
     @classmethod
     def read(cls, val):
-        if len(val) == 0: return 0
-        if val[0] == 1:
-            return -((1 << len(val)) - b2i(val))
-        else:
-            return b2i(val)
+        return to_signed(*val)
 
     @classmethod
     def write(cls, num, align=None):
-        tmp = bitarray('0', endian='big')
-        if num >= 0:
-            tmp.extend(_bin(num))
-        else:
-            tmp.extend(_bin(-num))
-            tmp.invert()
-            tmp = _bin(b2i(tmp) + 1)
+        n = 1 + bit_length(abs(num))
+        tmp = (num & ((1 << n) - 1), n)
         if align == None: return tmp
         else: return cls.align(tmp, align)
 
     @classmethod
     def align(cls, bits, align):
-        if align < len(bits):
-            raise AlignError('Illegal align number: %d -> %d' % (len(bits), align))
+        num, n = bits
+        if align < n:
+            raise AlignError('Illegal align number: %d -> %d' % (n, align))
+        elif n and num >> (n - 1):   # 符号拡張
+            return (num | ((1 << align) - (1 << n)), align)
         else:
-            b = '1' if bits[0] else '0'
-            return bitarray(b * (align - len(bits)), endian='big') + bits
+            return (num, align)
 
 
 class FB(object):